@@ -7,16 +7,36 @@ from flask import Flask, Response, request
 
 from datetime import datetime
 import json
+import os
+import threading
 
 # Setup and use the simple, common Python logging framework. Send log messages to the console.
-# The application should get the log level out of the context. We will change later.
+# The log level comes from GOT_LOG_LEVEL, e.g. INFO in production. The default is DEBUG.
 #
 import logging
-logging.basicConfig(level=logging.DEBUG)
+_log_level = os.environ.get("GOT_LOG_LEVEL", "DEBUG").upper()
+logging.basicConfig(level=_log_level)
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+logger.setLevel(_log_level)
+
+# Startup configuration.
+# - GOT_WARMUP_TABLES: Comma separated dbname.tablename list. Before reporting healthy, a worker opens
+#   connections and loads metadata for these tables, and builds the search index or relationship graph
+#   for those that have one.
+# - GOT_PRELOAD: If "true", the warm-up runs once at import, e.g. in the master process of a pre-forking
+#   server started with --preload. Indexes built there are shared with the workers. Each worker only
+#   re-opens its own connections after fork.
+#
+_warmup_tables = [t.strip() for t in os.environ.get("GOT_WARMUP_TABLES", "").split(",") if t.strip()]
+_preload = os.environ.get("GOT_PRELOAD", "false").lower() == "true"
 
+from src.data_tables.BaseDataTable import DataTableException
 from src.data_tables.RDBDataTable import RDBDataTable
+from src.data_tables.ConnectionRouter import ConnectionRouter
+from src.data_queries_tools_views.RelationshipGraph import RelationshipGraph
+from src.data_queries_tools_views.SearchIndex import SearchIndex
+from src.data_queries_tools_views.SingleFlight import SingleFlight
+from src.data_queries_tools_views.BatchExecutor import BatchExecutor
 import generate_links
 
 _data_tables = {}
@@ -53,18 +73,169 @@ def _get_default_context():
 
 _tables = {}
 
+# Tables, graphs and search indexes are created by request threads and by the warm-up thread. Without the
+# locks, two threads could each build one and the second would replace the first, e.g. a warmed up table.
+_tables_lock = threading.Lock()
+_cache_lock = threading.RLock()
+
 def _get_table(db_name, t_name):
 
     key = db_name + "." + t_name
     tbl = _tables.get(key, None)
 
     if tbl is None:
-        tbl = RDBDataTable(key)
-        _tables[key] = tbl
+        with _tables_lock:
+            tbl = _tables.get(key, None)
+            if tbl is None:
+                tbl = RDBDataTable(key)
+                _tables[key] = tbl
 
     return tbl
 
 
+_graphs = {}
+
+def _get_graph(db_name):
+
+    g = _graphs.get(db_name, None)
+
+    if g is None:
+        with _cache_lock:
+            g = _load_graph(db_name)
+
+    return g
+
+def _load_graph(db_name):
+
+    g = _graphs.get(db_name, None)
+
+    if g is None:
+        tbl = _get_table(db_name, "character_relationships")
+        rows = tbl.find_by_template(template={}, field_list=[RelationshipGraph.source_field,
+                                                             RelationshipGraph.label_field,
+                                                             RelationshipGraph.target_field])
+        if rows is None:
+            # Do not cache an empty graph for a failed query. The next request tries again.
+            raise DataTableException(DataTableException.query_failed,
+                                     "Could not read the relationships of " + db_name)
+
+        g = RelationshipGraph(rows)
+        tbl.add_write_listener(g.update_rows)
+        _graphs[db_name] = g
+
+    return g
+
+
+# Tables that support /api/<dbname>/<tablename>/search, the columns to index and the columns that identify a row.
+_search_config = {
+    "episodes": {
+        "text_columns": ["episodeTitle", "episodeDescription"],
+        "key_columns": ["seasonNum", "episodeNum"]
+    },
+    "characters": {
+        "text_columns": ["characterName", "nickname"],
+        "key_columns": ["character_id"]
+    },
+    "scenes": {
+        "text_columns": ["location", "subLocation"],
+        "key_columns": ["seasonNum", "episodeNum", "sceneNo"]
+    }
+}
+
+# Indexes are saved here so that a restart reloads them instead of reading the whole table again.
+_search_index_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Data", "index")
+
+_search_indexes = {}
+
+def _get_search_index(db_name, t_name):
+
+    idx = _search_indexes.get(db_name + "." + t_name, None)
+
+    if idx is None:
+        with _cache_lock:
+            idx = _load_search_index(db_name, t_name)
+
+    return idx
+
+def _load_search_index(db_name, t_name):
+
+    key = db_name + "." + t_name
+    idx = _search_indexes.get(key, None)
+
+    if idx is None:
+        config = _search_config.get(t_name, None)
+        if config is None:
+            return None
+
+        tbl = _get_table(db_name, t_name)
+        file_name = os.path.join(_search_index_dir, key + ".idx")
+
+        # The saved index is used only if it was built with the current configuration from a table with the
+        # same row signature, which includes CHECKSUM TABLE. Otherwise it is rebuilt from the table.
+        rows_signature = tbl.get_row_signature(config["key_columns"])
+        if rows_signature is None:
+            raise DataTableException(DataTableException.query_failed, "Could not read the signature of " + key)
+
+        version = {
+            "config": config,
+            "rows": rows_signature
+        }
+
+        if os.path.exists(file_name):
+            idx = SearchIndex.load(file_name)
+            if idx.version != version:
+                logger.info("_get_search_index: " + file_name + " is out of date. Rebuilding.")
+                idx = None
+
+        if idx is None:
+            rows = tbl.find_by_template(template={})
+            if rows is None:
+                # Do not cache or save an empty index for a failed query. The next request tries again.
+                raise DataTableException(DataTableException.query_failed, "Could not read " + key)
+
+            idx = SearchIndex(config["text_columns"], config["key_columns"])
+            idx.add_rows(rows)
+            idx.version = version
+            os.makedirs(_search_index_dir, exist_ok=True)
+            idx.save(file_name)
+
+        # Writes through this process update the index in memory. Any write, including an update in place,
+        # changes the table's checksum, so the saved file no longer matches and is rebuilt on the next start.
+        tbl.add_write_listener(idx.update_rows)
+        _search_indexes[key] = idx
+
+    return idx
+
+
+# Concurrent identical GETs on /api/<dbname>/<tablename> share one query and one serialized body.
+_single_flight = SingleFlight(max_waiters=100)
+
+def _find_table_rows(db_name, t_name, template, field_list):
+    """
+    Run the query for basic_table and serialize the result.
+    :return: (rsp_data, rsp_status, rsp_txt, rsp_body)
+    """
+    tbl = _get_table(db_name, t_name)
+
+    rsp = tbl.find_by_template(template=template, field_list=field_list)
+
+    if rsp is not None:
+        rsp_data = generate_links.add_links(db_name, t_name, rsp)
+        rsp_status = 200
+        rsp_txt = "OK"
+        rsp_body = json.dumps(rsp_data, default=str)
+    else:
+        rsp_data = None
+        rsp_status = 404
+        rsp_txt = "NOT FOUND"
+        rsp_body = None
+
+    return rsp_data, rsp_status, rsp_txt, rsp_body
+
+
+_batch_executor = BatchExecutor(_get_table, max_workers=8)
+
+
 
 # 1. Extract the input information from the requests object.
 # 2. Log the information
@@ -89,10 +260,9 @@ def log_and_extract_input(method, path_params=None):
 
     log_message = str(datetime.now()) + ": Method " + method
 
-    field_list = args.get('fields', None)
+    field_list = args.pop('fields', None)
     if field_list is not None:
         field_list = field_list.split(",")
-        del (args['fieldlist'])
 
     inputs =  {
         "path": path,
@@ -104,13 +274,18 @@ def log_and_extract_input(method, path_params=None):
         "field_list": field_list
         }
 
-    log_message += " received: \n" + json.dumps(inputs, indent=2)
-    logger.debug(log_message)
+    if logger.isEnabledFor(logging.DEBUG):
+        log_message += " received: \n" + json.dumps(inputs, indent=2)
+        logger.debug(log_message)
 
     return inputs
 
 def log_response(method, status, data, txt):
 
+    # Serializing a large result for a message that is not logged is wasted work.
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
     msg = {
         "method": method,
         "status": status,
@@ -136,9 +311,15 @@ def index_rsp():
 @application.route("/health", methods=["GET"])
 def health_check():
 
-    rsp_data = { "status": "healthy", "time": str(datetime.now()) }
+    if _ready.is_set():
+        rsp_data = { "status": "healthy", "time": str(datetime.now()), "coalescing": _single_flight.get_stats() }
+        rsp_status = 200
+    else:
+        rsp_data = { "status": "warming up", "time": str(datetime.now()) }
+        rsp_status = 503
+
     rsp_str = json.dumps(rsp_data)
-    rsp = Response(rsp_str, status=200, content_type="application/json")
+    rsp = Response(rsp_str, status=rsp_status, content_type="application/json")
     return rsp
 
 
@@ -164,41 +345,215 @@ def basic_table(dbname, tablename):
     rsp_status = None
     rsp_txt = None
 
-    try:
+    rsp_body = None
 
-        tbl = _get_table(dbname, tablename)
+    try:
 
         if inputs["method"] == "GET":
 
-            rsp = tbl.find_by_template(template=inputs['query_params'], field_list=inputs['field_list'])
+            template = inputs['query_params']
+            field_list = inputs['field_list']
+            key = (dbname, tablename, json.dumps(template, sort_keys=True, default=str), json.dumps(field_list))
 
-            if rsp is not None:
-                rsp_data = rsp
-                rsp_status = 200
-                rsp_txt = "OK"
-            else:
-                rsp_data = None
-                rsp_status = 404
-                rsp_txt = "NOT FOUND"
+            (rsp_data, rsp_status, rsp_txt, rsp_body), shared = _single_flight.do(
+                key, lambda: _find_table_rows(dbname, tablename, template, field_list))
+            if shared:
+                logger.debug("/dbname/tablename: coalesced with an in-flight query for " + str(key))
         else:
             rsp_data = None
             rsp_status = 501
             rsp_txt = "NOT IMPLEMENTED"
 
+        if rsp_body is not None:
+            full_rsp = Response(rsp_body, status=rsp_status, content_type="application/json")
+        else:
+            full_rsp = Response(rsp_txt, status=rsp_status, content_type="text/plain")
+
+    except DataTableException as e:
+        rsp_data = None
+        rsp_status = 400
+        rsp_txt = "BAD REQUEST: " + e.message
+        full_rsp = Response(rsp_txt, status=rsp_status, content_type="text/plain")
+
+    except Exception as e:
+        log_msg = "/dbname/tablename: Exception = " + str(e)
+        logger.error(log_msg)
+        rsp_status = 500
+        rsp_txt = "INTERNAL SERVER ERROR. Please take COMSE6156 -- Cloud Native Applications."
+        full_rsp = Response(rsp_txt, status=rsp_status, content_type="text/plain")
+
+    # Coalesced requests share one result. Log its size rather than serializing the rows again for each of them.
+    log_data = None if rsp_body is None else { "bytes": len(rsp_body) }
+    log_response("/dbname/tablename", rsp_status, log_data, rsp_txt)
+
+    return full_rsp
+
+
+# Traversals over character_relationships, served from the in-memory graph index.
+#   /api/<dbname>/_graph/bfs?source=Eddard Stark&labels=parentOf
+#   /api/<dbname>/_graph/neighborhood?source=Jon Snow&hops=3&direction=both
+#   /api/<dbname>/_graph/path?source=Jon Snow&target=Cersei Lannister&direction=both
+# The leading _ keeps the path apart from /api/<dbname>/<tablename>/search for a table named graph.
+@application.route("/api/<dbname>/_graph/<op>", methods=["GET"])
+def relationship_graph(dbname, op):
+
+    inputs = log_and_extract_input(demo, { "parameters": { "dbname": dbname, "op": op} })
+    rsp_data = None
+    rsp_status = None
+    rsp_txt = None
+
+    try:
+
+        g = _get_graph(dbname)
+
+        args = inputs['query_params']
+        source = args.get("source", None)
+        labels = args.get("labels", None)
+        if labels is not None:
+            labels = labels.split(",")
+        direction = args.get("direction", "out")
+        hops = args.get("hops", None)
+        if hops is not None and hops.isdigit():
+            hops = int(hops)
+        target = args.get("target", None)
+
+        if source is None or direction not in RelationshipGraph.directions or isinstance(hops, str) or \
+                (op == "path" and target is None):
+            rsp = None
+            rsp_status = 400
+            rsp_txt = "BAD REQUEST"
+        elif op == "bfs":
+            rsp = g.bfs(source, labels=labels, direction=direction, max_depth=hops)
+        elif op == "neighborhood":
+            rsp = g.neighborhood(source, hops if hops is not None else 1, labels=labels, direction=direction)
+        elif op == "path":
+            rsp = g.shortest_path(source, target, labels=labels, direction=direction)
+        else:
+            rsp = None
+            rsp_status = 501
+            rsp_txt = "NOT IMPLEMENTED"
+
+        if rsp is not None:
+            rsp_data = rsp
+            rsp_status = 200
+            rsp_txt = "OK"
+        elif rsp_status is None:
+            rsp_status = 404
+            rsp_txt = "NOT FOUND"
+
         if rsp_data is not None:
-            rsp_data = generate_links.add_links(dbname, tablename, rsp_data)
             full_rsp = Response(json.dumps(rsp_data, default=str), status=rsp_status, content_type="application/json")
         else:
             full_rsp = Response(rsp_txt, status=rsp_status, content_type="text/plain")
 
     except Exception as e:
-        log_msg = "/dbname/tablename: Exception = " + str(e)
+        log_msg = "/dbname/_graph/op: Exception = " + str(e)
+        logger.error(log_msg)
+        rsp_status = 500
+        rsp_txt = "INTERNAL SERVER ERROR. Please take COMSE6156 -- Cloud Native Applications."
+        full_rsp = Response(rsp_txt, status=rsp_status, content_type="text/plain")
+
+    log_response("/dbname/_graph/op", rsp_status, rsp_data, rsp_txt)
+
+    return full_rsp
+
+
+# Ranked full text search over the configured columns of a table, e.g.
+#   /api/<dbname>/episodes/search?q=jon arryn&limit=5
+@application.route("/api/<dbname>/<tablename>/search", methods=["GET"])
+def table_search(dbname, tablename):
+
+    inputs = log_and_extract_input(demo, { "parameters": { "dbname": dbname, "tablename": tablename} })
+    rsp_data = None
+    rsp_status = None
+    rsp_txt = None
+
+    try:
+
+        idx = _get_search_index(dbname, tablename)
+        args = inputs['query_params']
+        q = args.get("q", None)
+        limit = args.get("limit", "10")
+
+        if idx is None:
+            rsp_status = 404
+            rsp_txt = "NOT FOUND"
+        elif q is None or not limit.isdigit():
+            rsp_status = 400
+            rsp_txt = "BAD REQUEST"
+        else:
+            limit = int(limit)
+            prefix = args.get("prefix", "true").lower() != "false"
+            rsp_data = idx.search(q, limit=limit, prefix=prefix)
+            rsp_status = 200
+            rsp_txt = "OK"
+
+        if rsp_data is not None:
+            full_rsp = Response(json.dumps(rsp_data, default=str), status=rsp_status, content_type="application/json")
+        else:
+            full_rsp = Response(rsp_txt, status=rsp_status, content_type="text/plain")
+
+    except Exception as e:
+        log_msg = "/dbname/tablename/search: Exception = " + str(e)
         logger.error(log_msg)
         rsp_status = 500
         rsp_txt = "INTERNAL SERVER ERROR. Please take COMSE6156 -- Cloud Native Applications."
         full_rsp = Response(rsp_txt, status=rsp_status, content_type="text/plain")
 
-    log_response("/dbname/tablename", rsp_status, rsp_data, rsp_txt)
+    log_response("/dbname/tablename/search", rsp_status, rsp_data, rsp_txt)
+
+    return full_rsp
+
+
+# Many table lookups in one request. The body is
+#   { "dbname": ..., "operations": [ { "id": ..., "tablename": ..., "template": {...}, "fields": [...] }, ... ] }
+# See BatchExecutor for references between operations.
+@application.route("/api/batch", methods=["POST"])
+def batch():
+
+    inputs = log_and_extract_input(batch)
+    rsp_data = None
+    rsp_status = None
+    rsp_txt = None
+
+    try:
+
+        body = inputs["body"]
+
+        if not isinstance(body, dict):
+            rsp_status = 400
+            rsp_txt = "BAD REQUEST"
+        else:
+            rsp_data = _batch_executor.execute(body.get("operations", None), dbname=body.get("dbname", None))
+
+            for i, op in enumerate(body["operations"]):
+                op_id = str(op.get("id", i))
+                rows = rsp_data["results"].get(op_id, None)
+                if rows is not None:
+                    op_dbname = op.get("dbname", body.get("dbname", None))
+                    rsp_data["results"][op_id] = generate_links.add_links(op_dbname, op["tablename"], rows)
+            rsp_status = 200
+            rsp_txt = "OK"
+
+        if rsp_data is not None:
+            full_rsp = Response(json.dumps(rsp_data, default=str), status=rsp_status, content_type="application/json")
+        else:
+            full_rsp = Response(rsp_txt, status=rsp_status, content_type="text/plain")
+
+    except ValueError as e:
+        rsp_data = None
+        rsp_status = 400
+        rsp_txt = "BAD REQUEST: " + str(e)
+        full_rsp = Response(rsp_txt, status=rsp_status, content_type="text/plain")
+
+    except Exception as e:
+        log_msg = "/batch: Exception = " + str(e)
+        logger.error(log_msg)
+        rsp_status = 500
+        rsp_txt = "INTERNAL SERVER ERROR. Please take COMSE6156 -- Cloud Native Applications."
+        full_rsp = Response(rsp_txt, status=rsp_status, content_type="text/plain")
+
+    log_response("/batch", rsp_status, rsp_data, rsp_txt)
 
     return full_rsp
 
@@ -253,6 +608,83 @@ def user_email(email):
     return full_rsp
 """
 
+###################################################################################################################
+# Startup.
+
+# Set when the worker has finished warming up. /health reports 503 until then.
+_ready = threading.Event()
+
+
+def _warm_up(build_caches=True):
+    """
+    Open connections and load metadata for the GOT_WARMUP_TABLES tables. If build_caches is true, also build
+    their search indexes and relationship graphs.
+    """
+    start = datetime.now()
+
+    for key in _warmup_tables:
+        try:
+            db_name, t_name = key.split(".", 1)
+            _get_table(db_name, t_name).warm_up()
+
+            if build_caches:
+                if t_name in _search_config:
+                    _get_search_index(db_name, t_name)
+                if t_name == "character_relationships":
+                    _get_graph(db_name)
+
+        except Exception as e:
+            # A table that cannot be warmed up is loaded on its first request, as before.
+            logger.error("_warm_up: table = " + key + ", Exception = " + str(e))
+
+    logger.info("_warm_up: tables = " + str(_warmup_tables) + ", time = " + str(datetime.now() - start))
+
+
+def _start_worker():
+    """
+    Warm up in the background so the server can accept /health checks while connections are opened.
+    """
+    def run():
+        _warm_up(build_caches=not _preload)
+        _ready.set()
+
+    _ready.clear()
+    threading.Thread(target=run, name="warm_up", daemon=True).start()
+
+
+def _after_fork_in_child():
+    """
+    The child inherits the parent's connections, thread pool, locks and warm-up state. Sockets shared by two
+    processes interleave their MySQL traffic, threads do not survive fork(), a lock held by another parent
+    thread is never released and a warm-up that was running in the parent never finishes in the child. Drop
+    all of them and warm up again. This runs after every fork, whatever the configuration.
+    """
+    global _single_flight, _tables_lock, _cache_lock, _ready
+
+    _tables_lock = threading.Lock()
+    _cache_lock = threading.RLock()
+
+    ConnectionRouter.reset_all()
+
+    _single_flight = SingleFlight(max_waiters=100)
+    _batch_executor.reset()
+
+    _ready = threading.Event()
+    _start_worker()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+if _preload:
+    # Preloading means a pre-forking server imports the application once and then forks the workers.
+    # The master only builds shared state. Its connections would be unusable in the workers, so close them.
+    _warm_up(build_caches=True)
+    ConnectionRouter.reset_all(close=True)
+    _ready.set()
+else:
+    _start_worker()
+
+
 logger.debug("__name__ = " + str(__name__))
 # run the app.
 if __name__ == "__main__":
@@ -0,0 +1,270 @@
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+import json
+import re
+
+from src.data_tables.BaseDataTable import DataTableException
+
+import logging
+
+logger = logging.getLogger()
+
+
+class BatchExecutor():
+    """
+    Executes a list of table lookups submitted in one request.
+
+    A batch is a list of operations of the form:
+
+        {
+            "id": "scenes",
+            "dbname": "W4111GoTSolutionClean",
+            "tablename": "scenes",
+            "template": { "seasonNum": { "$ref": "episode.seasonNum" }, "episodeNum": 1 },
+            "fields": ["seasonNum", "episodeNum", "sceneNo", "location"]
+        }
+
+    A template value { "$ref": "<id>.<field>" } is replaced by the distinct values of field in the rows
+    returned by operation id. A template value that is a list matches any of its values. Note that refs on
+    several fields are matched independently, i.e. as an IN per field, not per row.
+
+    Operations are run in stages. A stage holds every operation whose refs are all resolved and its operations
+    run in parallel. Operations in a stage on the same table and fields whose template is a single column with
+    a single integer value are merged into one IN query and the rows are split back out afterwards by numeric
+    value, since the column may be an INT, DECIMAL or FLOAT and return 1, 1.00 or 1.0. Other values are not
+    merged because MySQL compares strings by collation, e.g. 'jon snow' = 'Jon Snow ', and
+    matching the rows back to their operations would need the same rules.
+    """
+
+    _integer_re = re.compile(r"^(0|-?[1-9][0-9]*)$")
+
+    def __init__(self, get_table, max_workers=8, max_operations=100):
+        """
+
+        :param get_table: Function (dbname, tablename) -> data table.
+        :param max_workers: Number of operations that may run at the same time.
+        :param max_operations: Maximum number of operations in a batch.
+        """
+        self._get_table = get_table
+        self._max_workers = max_workers
+        self._max_operations = max_operations
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="batch")
+
+    def reset(self):
+        """
+        Replace the thread pool. Call this in a child process after fork(), where the parent's threads do not exist.
+        """
+        self._pool = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="batch")
+
+    @staticmethod
+    def _get_refs(op):
+        result = []
+        for v in op["template"].values():
+            if isinstance(v, dict):
+                result.append(v["$ref"].split(".", 1)[0])
+        return result
+
+    def _validate(self, operations, dbname):
+
+        if not isinstance(operations, list) or not operations:
+            raise ValueError("operations must be a non-empty list.")
+        if len(operations) > self._max_operations:
+            raise ValueError("A batch may have at most " + str(self._max_operations) + " operations.")
+
+        result = []
+        ids = set()
+
+        for i, o in enumerate(operations):
+            if not isinstance(o, dict) or not o.get("tablename", None):
+                raise ValueError("Operation " + str(i) + " must be an object with a tablename.")
+
+            op = {
+                "id": str(o.get("id", i)),
+                "dbname": o.get("dbname", dbname),
+                "tablename": o["tablename"],
+                "template": o.get("template", None) or {},
+                "fields": o.get("fields", None)
+            }
+
+            if op["dbname"] is None:
+                raise ValueError("Operation " + op["id"] + " has no dbname.")
+            if op["id"] in ids:
+                raise ValueError("Duplicate operation id " + op["id"] + ".")
+
+            if not isinstance(op["template"], dict):
+                raise ValueError("Operation " + op["id"] + ": template must be an object.")
+            if op["fields"] is not None and (not isinstance(op["fields"], list) or
+                                             not all(isinstance(f, str) for f in op["fields"])):
+                raise ValueError("Operation " + op["id"] + ": fields must be a list of column names.")
+
+            for k, v in op["template"].items():
+                if isinstance(v, dict) and (not isinstance(v.get("$ref", None), str) or "." not in v["$ref"]):
+                    raise ValueError("Operation " + op["id"] + ": " + k + " must be a value, a list or "
+                                     "{ \"$ref\": \"<id>.<field>\" }.")
+
+            ids.add(op["id"])
+            result.append(op)
+
+        for op in result:
+            for r in self._get_refs(op):
+                if r not in ids:
+                    raise ValueError("Operation " + op["id"] + " refers to unknown operation " + r + ".")
+
+        return result
+
+    @staticmethod
+    def _resolve(op, results):
+        """
+        Replace refs in the template with the values from earlier results.
+        """
+        template = {}
+
+        for k, v in op["template"].items():
+            if isinstance(v, dict):
+                ref_id, ref_field = v["$ref"].split(".", 1)
+                values = []
+                for row in results[ref_id]:
+                    x = row.get(ref_field, None)
+                    if x is not None and x not in values:
+                        values.append(x)
+                template[k] = values
+            else:
+                template[k] = v
+
+        return template
+
+    @staticmethod
+    def _is_integer(v):
+        if isinstance(v, bool):
+            return False
+        return isinstance(v, int) or (isinstance(v, str) and BatchExecutor._integer_re.match(v) is not None)
+
+    @staticmethod
+    def _group(ops):
+        """
+        Group single column, single integer value lookups on the same table and fields.
+        :return: List of (column, [ops]) where column is None for operations that run on their own.
+        """
+        groups = {}
+        result = []
+
+        for op in ops:
+            t = op["resolved"]
+            if len(t) == 1 and BatchExecutor._is_integer(list(t.values())[0]):
+                column = list(t.keys())[0]
+                key = (op["dbname"], op["tablename"], column, json.dumps(op["fields"]))
+                if key not in groups:
+                    groups[key] = (column, [])
+                    result.append(groups[key])
+                groups[key][1].append(op)
+            else:
+                result.append((None, [op]))
+
+        return result
+
+    @staticmethod
+    def _number(v):
+        """
+        v as a Decimal, or None if it is not a finite number. Equal numbers of any type have equal Decimals.
+        """
+        if v is None or isinstance(v, bool):
+            return None
+        try:
+            result = Decimal(str(v))
+        except (InvalidOperation, ValueError):
+            return None
+        return result if result.is_finite() else None
+
+    @staticmethod
+    def _find(tbl, template, field_list):
+        """
+        find_by_template, except that a failed query raises instead of returning None.
+        """
+        rows = tbl.find_by_template(template=template, field_list=field_list)
+        if rows is None:
+            raise DataTableException(DataTableException.query_failed, "Query failed.")
+        return rows
+
+    def _run_group(self, column, ops):
+        """
+        :return: Dictionary of operation id -> rows.
+        """
+        first = ops[0]
+        tbl = self._get_table(first["dbname"], first["tablename"])
+
+        if column is None or len(ops) == 1:
+            rows = self._find(tbl, first["resolved"], first["fields"])
+            return {first["id"]: rows}
+
+        fields = first["fields"]
+        if fields is not None and column not in fields:
+            fields = fields + [column]
+
+        values = [op["resolved"][column] for op in ops]
+        rows = self._find(tbl, {column: values}, fields)
+
+        # The database may return 1, 1.00 or 1.0 where the request had "1", so match on the numeric value.
+        by_value = {}
+        for r in rows:
+            by_value.setdefault(self._number(r.get(column, None)), []).append(r)
+
+        result = {}
+        for op in ops:
+            op_rows = by_value.get(self._number(op["resolved"][column]), [])
+            if first["fields"] is not None and column not in first["fields"]:
+                op_rows = [{k: v for k, v in r.items() if k != column} for r in op_rows]
+            result[op["id"]] = op_rows
+
+        return result
+
+    def execute(self, operations, dbname=None):
+        """
+
+        :param operations: List of operations. See the class comment.
+        :param dbname: Default dbname for operations that do not have one.
+        :return: Dictionary of { "results": { id: rows }, "errors": { id: message } }
+        """
+        pending = self._validate(operations, dbname)
+        results = {}
+        errors = {}
+
+        while pending:
+            ready = []
+            waiting = []
+
+            for op in pending:
+                refs = self._get_refs(op)
+                failed = [r for r in refs if r in errors]
+                if failed:
+                    errors[op["id"]] = "Depends on failed operation " + failed[0] + "."
+                elif all(r in results for r in refs):
+                    ready.append(op)
+                else:
+                    waiting.append(op)
+
+            if not ready:
+                for op in waiting:
+                    if op["id"] not in errors:
+                        errors[op["id"]] = "Circular reference."
+                break
+
+            for op in ready:
+                op["resolved"] = self._resolve(op, results)
+
+            groups = self._group(ready)
+            futures = [(ops, self._pool.submit(self._run_group, column, ops)) for column, ops in groups]
+
+            for ops, f in futures:
+                try:
+                    results.update(f.result())
+                except Exception as e:
+                    logger.error("BatchExecutor: Exception = " + str(e))
+                    # Only our own messages go back to the client. A driver's may name hosts or schema details.
+                    message = e.message if isinstance(e, DataTableException) else "Query failed."
+                    for op in ops:
+                        errors[op["id"]] = message
+
+            pending = [op for op in waiting if op["id"] not in errors]
+
+        result = {"results": results, "errors": errors}
+        return result
@@ -0,0 +1,324 @@
+from array import array
+from collections import deque
+import threading
+import csv
+
+import logging
+
+logger = logging.getLogger()
+
+
+class RelationshipGraph():
+    """
+    An in-memory adjacency index over the character_relationships table.
+
+    Each row of the table, e.g. ('CH_1', 'Aegon Targaryen', 'parents', 'Elia Martell'), is a directed edge
+    labeled 'parents' from 'Aegon Targaryen' to 'Elia Martell'. Names are mapped to integer ids and each label
+    is compacted into CSR (compressed sparse row) arrays: offsets[i]..offsets[i+1] is the slice of targets
+    holding the neighbors of node i. A reverse CSR is kept for following edges backwards.
+
+    Writes (add_rows/remove_rows) update an edge set and mark the label dirty. Dirty labels are re-compacted
+    the next time a query touches them, so a write only costs a rebuild of the labels it changed.
+
+    Rows whose label is an attribute rather than a relationship between characters, e.g. houseName ('Stark')
+    or actors (a description of an actor), are not part of the graph.
+    """
+
+    # Columns of character_relationships the graph uses.
+    source_field = "characterName"
+    label_field = "label"
+    target_field = "value"
+
+    directions = ("out", "in", "both")
+
+    attribute_labels = ("actors", "houseName")
+
+    def __init__(self, rows=None):
+        """
+
+        :param rows: Optional list of dictionaries with characterName, label and value fields.
+        """
+        self._lock = threading.RLock()
+        self._ids = {}          # name -> integer id
+        self._names = []        # integer id -> name
+        self._edges = {}        # label -> set of (source id, target id)
+        self._csr = {}          # label -> (offsets, targets, reverse offsets, reverse targets)
+        self._dirty = set()     # labels whose CSR arrays are stale
+
+        if rows is not None:
+            self.add_rows(rows)
+
+    @classmethod
+    def from_csv(cls, file_name):
+        """
+        Build a graph from a CSV export of the table, e.g. Data/csv/character_relationships.csv.
+        :param file_name: Path to the CSV file.
+        :return: A RelationshipGraph.
+        """
+        with open(file_name, "r", newline="") as in_file:
+            return cls(csv.DictReader(in_file))
+
+    def __str__(self):
+        result = "RelationshipGraph: nodes = " + str(len(self._names)) + \
+            ", edges = " + str(sum(len(e) for e in self._edges.values())) + \
+            ", labels = " + str(sorted(self._edges.keys()))
+        return result
+
+    def _get_id(self, name, create=False):
+
+        node_id = self._ids.get(name, None)
+
+        if node_id is None and create:
+            node_id = len(self._names)
+            self._ids[name] = node_id
+            self._names.append(name)
+
+        return node_id
+
+    def _row_to_edge(self, row, create):
+
+        source = row.get(self.source_field, None)
+        label = row.get(self.label_field, None)
+        target = row.get(self.target_field, None)
+
+        if not source or not label or not target or label in self.attribute_labels:
+            return None
+
+        s_id = self._get_id(source, create)
+        t_id = self._get_id(target, create)
+
+        if s_id is None or t_id is None:
+            return None
+
+        return label, s_id, t_id
+
+    def add_rows(self, rows):
+        """
+        Add edges for new rows in character_relationships. Call this after inserts into the table.
+        :param rows: List of row dictionaries.
+        :return: The number of edges added.
+        """
+        count = 0
+
+        with self._lock:
+            for r in rows:
+                edge = self._row_to_edge(r, create=True)
+                if edge is None:
+                    continue
+
+                label, s_id, t_id = edge
+                edges = self._edges.setdefault(label, set())
+                if (s_id, t_id) not in edges:
+                    edges.add((s_id, t_id))
+                    self._dirty.add(label)
+                    count += 1
+
+        return count
+
+    def remove_rows(self, rows):
+        """
+        Remove edges for rows deleted from character_relationships. Call this after deletes from the table.
+        Nodes are never removed, so ids stay stable.
+        :param rows: List of row dictionaries.
+        :return: The number of edges removed.
+        """
+        count = 0
+
+        with self._lock:
+            for r in rows:
+                edge = self._row_to_edge(r, create=False)
+                if edge is None:
+                    continue
+
+                label, s_id, t_id = edge
+                edges = self._edges.get(label, None)
+                if edges is not None and (s_id, t_id) in edges:
+                    edges.remove((s_id, t_id))
+                    self._dirty.add(label)
+                    count += 1
+
+        return count
+
+    def update_rows(self, old_rows, new_rows):
+        """
+        Apply an update to character_relationships as a remove of the old rows and an add of the new rows.
+        :param old_rows: The rows as they were before the update.
+        :param new_rows: The rows after the update.
+        :return: None
+        """
+        with self._lock:
+            self.remove_rows(old_rows)
+            self.add_rows(new_rows)
+
+    def labels(self):
+        return sorted(self._edges.keys())
+
+    def _compact(self, pairs):
+        """
+        Convert a list of (source id, target id) pairs into CSR offsets and targets arrays.
+        """
+        n = len(self._names)
+        offsets = array("l", [0]) * (n + 1)
+
+        for s, t in pairs:
+            offsets[s + 1] += 1
+
+        for i in range(n):
+            offsets[i + 1] += offsets[i]
+
+        targets = array("l", [0]) * len(pairs)
+        fill = array("l", offsets[:n])
+
+        for s, t in pairs:
+            targets[fill[s]] = t
+            fill[s] += 1
+
+        return offsets, targets
+
+    def _get_csr(self, label):
+
+        with self._lock:
+            csr = self._csr.get(label, None)
+
+            if label in self._dirty or csr is None:
+                pairs = sorted(self._edges.get(label, ()))
+                offsets, targets = self._compact(pairs)
+                r_offsets, r_targets = self._compact(sorted((t, s) for s, t in pairs))
+                csr = (offsets, targets, r_offsets, r_targets)
+                self._csr[label] = csr
+                self._dirty.discard(label)
+
+        return csr
+
+    def _adjacency(self, labels, direction):
+
+        if direction not in self.directions:
+            raise ValueError("direction must be one of " + str(self.directions))
+
+        if labels is None:
+            labels = self.labels()
+
+        result = []
+        for l in labels:
+            if l not in self._edges:
+                continue
+            offsets, targets, r_offsets, r_targets = self._get_csr(l)
+            if direction in ("out", "both"):
+                result.append((offsets, targets))
+            if direction in ("in", "both"):
+                result.append((r_offsets, r_targets))
+
+        return result
+
+    def _bfs(self, source, labels, direction, max_depth=None, target=None):
+        """
+        Breadth first search from source.
+        :return: (depth by node id, parent by node id) or None if source is unknown.
+        """
+        s_id = self._ids.get(source, None)
+        if s_id is None:
+            return None
+
+        t_id = self._ids.get(target, None) if target is not None else None
+        adjacency = self._adjacency(labels, direction)
+
+        depth = {s_id: 0}
+        parent = {s_id: None}
+        frontier = deque([s_id])
+
+        while frontier:
+            n = frontier.popleft()
+            d = depth[n]
+
+            if n == t_id:
+                break
+            if max_depth is not None and d >= max_depth:
+                continue
+
+            for offsets, targets in adjacency:
+                # Nodes added after this label was compacted have no edges with this label.
+                if n >= len(offsets) - 1:
+                    continue
+                for i in range(offsets[n], offsets[n + 1]):
+                    m = targets[i]
+                    if m not in depth:
+                        depth[m] = d + 1
+                        parent[m] = n
+                        frontier.append(m)
+
+        return depth, parent
+
+    def neighbors(self, source, labels=None, direction="out"):
+        """
+
+        :param source: Name of the starting node, e.g. 'Jon Snow'
+        :param labels: List of labels to follow, e.g. ['parents', 'siblings']. None means all labels.
+        :param direction: 'out', 'in' or 'both'
+        :return: List of names one hop away, or None if the node is unknown.
+        """
+        return self.neighborhood(source, 1, labels=labels, direction=direction)
+
+    def neighborhood(self, source, hops, labels=None, direction="out"):
+        """
+
+        :param source: Name of the starting node.
+        :param hops: Maximum number of hops, e.g. 3 for 'who is within 3 hops of Jon Snow'
+        :param labels: List of labels to follow. None means all labels.
+        :param direction: 'out', 'in' or 'both'
+        :return: List of {"name": ..., "hops": ...} ordered by hops, or None if the node is unknown.
+        """
+        result = self.bfs(source, labels=labels, direction=direction, max_depth=hops)
+        if result is not None:
+            result = [r for r in result if r["hops"] > 0]
+        return result
+
+    def bfs(self, source, labels=None, direction="out", max_depth=None):
+        """
+        All nodes reachable from source. 'All descendants of X' is bfs(X, labels=['parentOf']).
+
+        :param source: Name of the starting node.
+        :param labels: List of labels to follow. None means all labels.
+        :param direction: 'out', 'in' or 'both'
+        :param max_depth: Stop after this many hops. None means no limit.
+        :return: List of {"name": ..., "hops": ...} in BFS order, including source, or None if unknown.
+        """
+        with self._lock:
+            r = self._bfs(source, labels, direction, max_depth=max_depth)
+            if r is None:
+                return None
+
+            depth, parent = r
+            result = [{"name": self._names[n], "hops": d} for n, d in depth.items()]
+
+        return result
+
+    def shortest_path(self, source, target, labels=None, direction="out"):
+        """
+
+        :param source: Name of the starting node.
+        :param target: Name of the node to reach.
+        :param labels: List of labels to follow. None means all labels.
+        :param direction: 'out', 'in' or 'both'
+        :return: List of names from source to target, or None if either is unknown or there is no path.
+        """
+        with self._lock:
+            if target not in self._ids:
+                return None
+
+            r = self._bfs(source, labels, direction, target=target)
+            if r is None:
+                return None
+
+            depth, parent = r
+            t_id = self._ids[target]
+            if t_id not in parent:
+                return None
+
+            result = []
+            n = t_id
+            while n is not None:
+                result.append(self._names[n])
+                n = parent[n]
+
+        result.reverse()
+        return result
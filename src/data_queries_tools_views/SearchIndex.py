@@ -0,0 +1,249 @@
+from bisect import bisect_left
+import math
+import os
+import pickle
+import re
+import threading
+
+import logging
+
+logger = logging.getLogger()
+
+
+class SearchIndex():
+    """
+    A tokenized inverted index over some text columns of a data table.
+
+    Every row is a document identified by the values of its key columns. The index maps each token to the
+    documents containing it and the token's count in each document. A sorted token list supports prefix
+    matches, e.g. 'targ' matches 'targaryen'. Results are ranked with BM25.
+
+    The index holds the rows themselves (restricted to the stored columns), so a search never goes to the
+    database. add_rows/remove_rows/update_rows keep it current after inserts, updates and deletes.
+
+    version is an opaque value saved with the index, e.g. the configuration and a signature of the table it
+    was built from. The owner compares it after load() to decide whether the saved index is stale.
+    """
+
+    _token_re = re.compile(r"[a-z0-9]+")
+
+    # BM25 parameters.
+    _k1 = 1.2
+    _b = 0.75
+
+    def __init__(self, text_columns, key_columns, stored_columns=None):
+        """
+
+        :param text_columns: List of columns to tokenize, e.g. ['characterName', 'nickname']
+        :param key_columns: List of columns that identify a row, e.g. ['character_id']
+        :param stored_columns: List of columns to keep and return for each match. None means keep the whole row.
+        """
+        self._text_columns = text_columns
+        self._key_columns = key_columns
+        self._stored_columns = stored_columns
+
+        self._lock = threading.RLock()
+        self._docs = {}             # key tuple -> (stored row, {token: count}, length)
+        self._postings = {}         # token -> {key tuple: count}
+        self._total_length = 0
+        self._sorted_tokens = None  # Rebuilt on demand after the token set changes.
+
+        self.version = None
+
+    def __str__(self):
+        result = "SearchIndex: text_columns = " + str(self._text_columns) + \
+            ", documents = " + str(len(self._docs)) + ", tokens = " + str(len(self._postings))
+        return result
+
+    def __len__(self):
+        return len(self._docs)
+
+    @classmethod
+    def tokenize(cls, text):
+        if text is None:
+            return []
+        return cls._token_re.findall(str(text).lower())
+
+    def _get_key(self, row):
+        return tuple(row.get(k, None) for k in self._key_columns)
+
+    def _remove_key(self, key):
+
+        doc = self._docs.pop(key, None)
+        if doc is None:
+            return False
+
+        row, counts, length = doc
+        self._total_length -= length
+
+        for t in counts:
+            p = self._postings[t]
+            del p[key]
+            if not p:
+                del self._postings[t]
+                self._sorted_tokens = None
+
+        return True
+
+    def add_rows(self, rows):
+        """
+        Index new or changed rows. A row whose key is already indexed replaces the old version.
+        :param rows: List of row dictionaries. They must contain the key and text columns.
+        :return: Number of rows indexed.
+        """
+        count = 0
+
+        with self._lock:
+            for r in rows:
+                key = self._get_key(r)
+                self._remove_key(key)
+
+                counts = {}
+                for c in self._text_columns:
+                    for t in self.tokenize(r.get(c, None)):
+                        counts[t] = counts.get(t, 0) + 1
+
+                if self._stored_columns is None:
+                    row = dict(r)
+                else:
+                    row = {c: r.get(c, None) for c in self._stored_columns}
+
+                length = sum(counts.values())
+                self._docs[key] = (row, counts, length)
+                self._total_length += length
+
+                for t, n in counts.items():
+                    p = self._postings.get(t, None)
+                    if p is None:
+                        p = {}
+                        self._postings[t] = p
+                        self._sorted_tokens = None
+                    p[key] = n
+
+                count += 1
+
+        return count
+
+    def remove_rows(self, rows):
+        """
+        Remove rows from the index. Only the key columns of each row are used.
+        :param rows: List of row dictionaries.
+        :return: Number of rows removed.
+        """
+        count = 0
+
+        with self._lock:
+            for r in rows:
+                if self._remove_key(self._get_key(r)):
+                    count += 1
+
+        return count
+
+    def update_rows(self, old_rows, new_rows):
+        """
+        Apply an update as a remove of the old rows and an add of the new rows. A change to a key column
+        moves the row to its new key.
+        :param old_rows: The rows as they were before the update.
+        :param new_rows: The rows after the update.
+        :return: None
+        """
+        with self._lock:
+            self.remove_rows(old_rows)
+            self.add_rows(new_rows)
+
+    def _expand(self, token):
+        """
+        All indexed tokens that start with token.
+        """
+        if self._sorted_tokens is None:
+            self._sorted_tokens = sorted(self._postings.keys())
+
+        result = []
+        i = bisect_left(self._sorted_tokens, token)
+        while i < len(self._sorted_tokens) and self._sorted_tokens[i].startswith(token):
+            result.append(self._sorted_tokens[i])
+            i += 1
+
+        return result
+
+    def search(self, text, limit=10, prefix=True):
+        """
+
+        :param text: Query text, e.g. 'jon snow' or 'targ'
+        :param limit: Maximum number of results.
+        :param prefix: If true, each query word also matches the tokens that begin with it.
+        :return: List of {"score": ..., "row": ...}, best match first.
+        """
+        with self._lock:
+            n_docs = len(self._docs)
+            if n_docs == 0:
+                return []
+
+            avg_length = self._total_length / n_docs
+            scores = {}
+
+            for q in set(self.tokenize(text)):
+                tokens = self._expand(q) if prefix else ([q] if q in self._postings else [])
+
+                # A query word scores each document once, using its best matching token.
+                best = {}
+                for t in tokens:
+                    p = self._postings[t]
+                    idf = math.log(1 + (n_docs - len(p) + 0.5) / (len(p) + 0.5))
+                    for key, n in p.items():
+                        length = self._docs[key][2]
+                        s = idf * n * (self._k1 + 1) / \
+                            (n + self._k1 * (1 - self._b + self._b * length / avg_length))
+                        if s > best.get(key, 0):
+                            best[key] = s
+
+                for key, s in best.items():
+                    scores[key] = scores.get(key, 0) + s
+
+            ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+            if limit is not None:
+                ranked = ranked[:limit]
+
+            result = [{"score": round(s, 4), "row": self._docs[key][0]} for key, s in ranked]
+
+        return result
+
+    def save(self, file_name):
+        """
+        Write the index to a file. The file is replaced atomically so a reader never sees a partial index.
+        :param file_name: Path of the index file.
+        :return: None
+        """
+        with self._lock:
+            state = {
+                "text_columns": self._text_columns,
+                "key_columns": self._key_columns,
+                "stored_columns": self._stored_columns,
+                "docs": self._docs,
+                "postings": self._postings,
+                "total_length": self._total_length,
+                "version": self.version
+            }
+
+            tmp_name = file_name + ".tmp"
+            with open(tmp_name, "wb") as out_file:
+                pickle.dump(state, out_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_name, file_name)
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Read an index written by save().
+        :param file_name: Path of the index file.
+        :return: A SearchIndex
+        """
+        with open(file_name, "rb") as in_file:
+            state = pickle.load(in_file)
+
+        result = cls(state["text_columns"], state["key_columns"], state["stored_columns"])
+        result._docs = state["docs"]
+        result._postings = state["postings"]
+        result._total_length = state["total_length"]
+        result.version = state.get("version", None)
+
+        return result
@@ -0,0 +1,105 @@
+import threading
+
+import logging
+
+logger = logging.getLogger()
+
+
+class _Call():
+    """
+    One in-flight execution and the requests waiting for its result.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight():
+    """
+    Coalesces concurrent identical requests. The first caller for a key runs the function. Callers that
+    arrive with the same key while it is running wait for that run and get the same result (or exception)
+    instead of running the function again.
+
+    A key only has waiters while a call is in flight. Nothing is cached after the call completes.
+    """
+
+    def __init__(self, max_waiters=100):
+        """
+
+        :param max_waiters: Maximum number of callers that wait on one in-flight call. Callers past the limit
+            run the function themselves, so one slow query cannot hold an unbounded number of threads.
+        """
+        self._max_waiters = max_waiters
+        self._lock = threading.Lock()
+        self._calls = {}
+
+        self._stats = {
+            "calls": 0,         # Total calls to do().
+            "executions": 0,    # Calls that ran the function.
+            "coalesced": 0,     # Calls that shared another call's result.
+            "overflow": 0       # Calls that ran the function because max_waiters was reached.
+        }
+
+    def do(self, key, fn):
+        """
+
+        :param key: A hashable key. Calls with equal keys must produce interchangeable results.
+        :param fn: A function with no arguments that computes the result.
+        :return: (result, shared) where shared is True if the result came from another caller's run.
+        """
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._calls.get(key, None)
+
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+            elif call.waiters < self._max_waiters:
+                call.waiters += 1
+                self._stats["coalesced"] += 1
+                leader = False
+            else:
+                self._stats["overflow"] += 1
+                self._stats["executions"] += 1
+                call = None
+                leader = False
+
+        if call is None:
+            return fn(), False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+        finally:
+            with self._lock:
+                self._stats["executions"] += 1
+                del self._calls[key]
+            call.done.set()
+
+        if call.error is not None:
+            raise call.error
+
+        return call.result, False
+
+    def get_stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result["in_flight"] = len(self._calls)
+
+        if result["calls"] > 0:
+            result["coalesced_ratio"] = round(result["coalesced"] / result["calls"], 4)
+        else:
+            result["coalesced_ratio"] = 0.0
+
+        return result
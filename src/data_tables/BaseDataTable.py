@@ -11,6 +11,9 @@ class DataTableException(Exception):
     """
 
     invalid_method = 1001
+    invalid_table = 1002
+    invalid_column = 1003
+    query_failed = 1004
 
     # General
     def __init__(self, code, message):
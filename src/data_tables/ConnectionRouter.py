@@ -0,0 +1,399 @@
+import itertools
+import json
+import os
+import threading
+import time
+
+import logging
+
+logger = logging.getLogger()
+
+
+class ConnectionRouter():
+    """
+    Routes queries to a primary MySQL host or to one of its read replicas.
+
+    connect_info is either a single host, as before:
+
+        {'host': 'localhost', 'user': 'dbuser', 'password': 'dbuserdbuser', 'db': 'W4111GoTSolutionClean',
+            'port': 3306}
+
+    or a primary plus replicas. Replicas inherit any setting they do not override, so several local
+    MySQL instances on different ports can be described as:
+
+        {
+            'primary': {'host': 'localhost', 'user': 'dbuser', 'password': 'dbuserdbuser',
+                'db': 'W4111GoTSolutionClean', 'port': 3306},
+            'replicas': [{'port': 3307}, {'port': 3308}],
+            'replica_policy': 'round_robin',        # or 'least_loaded'
+            'eject_seconds': 30,                    # How long a failed replica is skipped.
+            'read_your_writes_seconds': 5,          # How long a session reads from the primary after a write.
+            'pool_size': 8                          # Idle connections kept per host.
+        }
+
+    Reads go to a replica and writes go to the primary. A read with context {'consistency': 'primary'}, or a
+    read in a session (context {'session_id': ...}) that wrote within read_your_writes_seconds, also goes to
+    the primary. If no replica is healthy, reads fall back to the primary.
+
+    pymysql connections are not thread safe, so each host has a pool of connections and a connection is used
+    by one query at a time. Pooled connections are in autocommit mode, so every statement run on one commits
+    and a read never holds a transaction (and its REPEATABLE READ snapshot) open while the connection sits in
+    the pool. A caller that needs a multi-statement transaction uses get_primary_cnx(), which is not in
+    autocommit mode, and commits or rolls back itself.
+
+    A child process made by fork() inherits the router with the parent's connections. Sharing a socket would
+    interleave the two processes' MySQL traffic, so the router remembers the process that opened its
+    connections and drops them, without closing, the first time it is used in another process.
+
+    Use get_router() rather than the constructor so that all tables with the same connect_info share one
+    router, i.e. one pool, one set of load counts and one view of replica health per host.
+    """
+
+    policies = ("round_robin", "least_loaded")
+
+    # Connections idle for longer than this are pinged before use, since MySQL may have closed them.
+    _ping_idle_seconds = 60
+
+    # Shared routers by connect_info.
+    _routers = {}
+    _routers_lock = threading.Lock()
+
+    @classmethod
+    def get_router(cls, connect_info):
+        """
+
+        :param connect_info: Connection information. See the class comment.
+        :return: The ConnectionRouter for connect_info, created on first use.
+        """
+        key = json.dumps(connect_info, sort_keys=True, default=str)
+
+        with cls._routers_lock:
+            router = cls._routers.get(key, None)
+            if router is None:
+                router = cls(connect_info)
+                cls._routers[key] = router
+
+        return router
+
+    @classmethod
+    def reset_all(cls, close=False):
+        """
+        Call reset() on every shared router.
+        """
+        cls._routers_lock = threading.Lock()
+        for router in list(cls._routers.values()):
+            router.reset(close=close)
+
+    @staticmethod
+    def is_connection_error(e):
+        """
+        Connection level errors mean the host is unreachable or the connection is broken. Errors in the
+        query itself, e.g. a bad column name, do not say anything about the health of the host.
+
+        The errors are recognized by their DB API (PEP 249) class names, OperationalError and InterfaceError,
+        so the routing logic does not depend on the driver's exception module.
+        """
+        if e is None:
+            return False
+        return any(c.__name__ in ("OperationalError", "InterfaceError") for c in type(e).__mro__)
+
+    def __init__(self, connect_info):
+
+        if 'primary' in connect_info:
+            primary = connect_info['primary']
+            replicas = [{**primary, **r} for r in connect_info.get('replicas', [])]
+        else:
+            primary = connect_info
+            replicas = []
+
+        self._policy = connect_info.get('replica_policy', 'round_robin')
+        if self._policy not in ConnectionRouter.policies:
+            raise ValueError("replica_policy must be one of " + str(ConnectionRouter.policies))
+
+        self._eject_seconds = connect_info.get('eject_seconds', 30)
+        self._read_your_writes_seconds = connect_info.get('read_your_writes_seconds', 5)
+        self._pool_size = connect_info.get('pool_size', 8)
+
+        # Host 0 is the primary.
+        self._hosts = [primary] + replicas
+
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._idle = [[] for h in self._hosts]
+        self._next_replica = itertools.count()
+        self._in_flight = [0] * len(self._hosts)
+        self._ejected_until = [0] * len(self._hosts)
+        self._last_write = {}       # session_id -> time of last write
+
+    def __str__(self):
+        result = "ConnectionRouter: primary = " + self._host_name(0) + \
+            ", replicas = " + str([self._host_name(i) for i in range(1, len(self._hosts))]) + \
+            ", policy = " + self._policy
+        return result
+
+    def _host_name(self, i):
+        h = self._hosts[i]
+        return str(h.get('host', None)) + ":" + str(h.get('port', 3306))
+
+    def _connect(self, i, autocommit=True):
+
+        # The driver is only needed to open connections.
+        import pymysql
+
+        c_info = self._hosts[i]
+
+        return pymysql.connect(
+            host=c_info['host'],
+            user=c_info['user'],
+            password=c_info['password'],
+            db=c_info['db'],
+            port=c_info.get('port', 3306),
+            charset='utf8mb4',
+            autocommit=autocommit,
+            cursorclass=pymysql.cursors.DictCursor)
+
+    def _check_pid(self):
+        """
+        Drop connections inherited from the parent process.
+        """
+        if self._pid != os.getpid():
+            self.reset()
+
+    def _get_pooled_cnx(self, i):
+
+        with self._lock:
+            idle = self._idle[i]
+            cnx, returned_at = idle.pop() if idle else (None, None)
+
+        if cnx is None:
+            cnx = self._connect(i)
+        elif time.time() - returned_at > ConnectionRouter._ping_idle_seconds:
+            cnx.ping(reconnect=True)
+
+        return cnx
+
+    def _return_cnx(self, i, cnx):
+
+        with self._lock:
+            if len(self._idle[i]) < self._pool_size:
+                self._idle[i].append((cnx, time.time()))
+                cnx = None
+
+        if cnx is not None:
+            self._close(cnx)
+
+    @staticmethod
+    def _close(cnx):
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+    def _eject(self, i, e):
+
+        if i == 0:
+            return
+
+        logger.error("ConnectionRouter: ejecting replica " + self._host_name(i) + " for " +
+                     str(self._eject_seconds) + " seconds. Exception = " + str(e))
+        with self._lock:
+            self._ejected_until[i] = time.time() + self._eject_seconds
+
+    def _use_primary(self, read_only, context):
+
+        if not read_only or len(self._hosts) == 1:
+            return True
+
+        if context is None:
+            return False
+
+        if context.get('consistency', None) == 'primary':
+            return True
+
+        session_id = context.get('session_id', None)
+        if session_id is not None:
+            last_write = self._last_write.get(session_id, None)
+            if last_write is not None and time.time() - last_write < self._read_your_writes_seconds:
+                return True
+
+        return False
+
+    def _replica_candidates(self):
+        """
+        Healthy replicas in the order they should be tried.
+        """
+        now = time.time()
+
+        with self._lock:
+            healthy = [i for i in range(1, len(self._hosts)) if self._ejected_until[i] <= now]
+            if not healthy:
+                return []
+
+            if self._policy == 'least_loaded':
+                healthy.sort(key=lambda i: self._in_flight[i])
+            else:
+                start = next(self._next_replica) % len(healthy)
+                healthy = healthy[start:] + healthy[:start]
+
+        return healthy
+
+    def _record_write(self, session_id):
+
+        now = time.time()
+
+        with self._lock:
+            self._last_write[session_id] = now
+
+            # Sessions that have not written recently no longer need the primary.
+            if len(self._last_write) > 10000:
+                self._last_write = {k: v for k, v in self._last_write.items()
+                                    if now - v < self._read_your_writes_seconds}
+
+    def acquire(self, read_only=False, context=None, exclude=None):
+        """
+
+        :param read_only: True for SELECTs that may be served by a replica.
+        :param context: None or a dictionary that may contain 'consistency' and 'session_id'.
+        :param exclude: Index of a replica not to use, e.g. one that just failed. The primary is never excluded.
+        :return: A ConnectionLease. Call release() on it when the query is done.
+        """
+        self._check_pid()
+
+        if self._use_primary(read_only, context):
+            candidates = [0]
+        else:
+            candidates = [i for i in self._replica_candidates() if i != exclude] + [0]
+
+        for i in candidates:
+            try:
+                cnx = self._get_pooled_cnx(i)
+            except Exception as e:
+                if i == 0 or not ConnectionRouter.is_connection_error(e):
+                    raise e
+                self._eject(i, e)
+                continue
+
+            with self._lock:
+                self._in_flight[i] += 1
+
+            write_session_id = None
+            if not read_only and context is not None:
+                write_session_id = context.get('session_id', None)
+                if write_session_id is not None:
+                    self._record_write(write_session_id)
+
+            return ConnectionLease(self, i, cnx, write_session_id)
+
+    def _release(self, i, cnx, error=None, write_session_id=None):
+
+        # A lease taken before fork() belongs to the parent's pool.
+        if self._pid != os.getpid():
+            return
+
+        with self._lock:
+            self._in_flight[i] -= 1
+
+        # The read-your-writes window starts when the write finishes, not when it started.
+        if write_session_id is not None:
+            self._record_write(write_session_id)
+
+        if ConnectionRouter.is_connection_error(error):
+            self._close(cnx)
+            self._eject(i, error)
+        else:
+            self._return_cnx(i, cnx)
+
+    def get_primary_cnx(self):
+        """
+        A connection to the primary that belongs to the calling thread and is not shared through the pool. It is
+        not in autocommit mode, so the caller commits or rolls back.
+        """
+        self._check_pid()
+
+        cnx = getattr(self._local, "primary_cnx", None)
+        if cnx is None:
+            cnx = self._connect(0, autocommit=False)
+            self._local.primary_cnx = cnx
+        return cnx
+
+    def warm_up(self, n=2):
+        """
+        Open connections ahead of the first queries.
+        :param n: Number of idle connections to have ready for each healthy host.
+        :return: Number of connections opened.
+        """
+        self._check_pid()
+
+        count = 0
+        now = time.time()
+
+        for i in range(len(self._hosts)):
+            if self._ejected_until[i] > now:
+                continue
+
+            with self._lock:
+                missing = min(n, self._pool_size) - len(self._idle[i])
+
+            for j in range(missing):
+                try:
+                    cnx = self._connect(i)
+                except Exception as e:
+                    if i == 0 or not ConnectionRouter.is_connection_error(e):
+                        raise e
+                    self._eject(i, e)
+                    break
+                self._return_cnx(i, cnx)
+                count += 1
+
+        return count
+
+    def reset(self, close=False):
+        """
+        Forget every pooled connection, e.g. in a child process after fork(). A child must not close them
+        because that would send a QUIT on a socket the parent process is still using.
+        :param close: Close the idle connections. Only the process that opened them should do this.
+        """
+        if close:
+            for idle in self._idle:
+                for cnx, returned_at in idle:
+                    self._close(cnx)
+
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._idle = [[] for h in self._hosts]
+        self._in_flight = [0] * len(self._hosts)
+
+    def get_stats(self):
+        now = time.time()
+        result = [
+            {
+                "host": self._host_name(i),
+                "role": "primary" if i == 0 else "replica",
+                "in_flight": self._in_flight[i],
+                "idle": len(self._idle[i]),
+                "healthy": self._ejected_until[i] <= now
+            }
+            for i in range(len(self._hosts))
+        ]
+        return result
+
+
+class ConnectionLease():
+    """
+    A connection handed out by ConnectionRouter.acquire() for one query.
+    """
+
+    def __init__(self, router, host_index, cnx, write_session_id=None):
+        self._router = router
+        self.host_index = host_index
+        self.cnx = cnx
+        self._write_session_id = write_session_id
+        self._error = None
+
+    def failed(self, error):
+        self._error = error
+
+    def release(self):
+        self._router._release(self.host_index, self.cnx, self._error, self._write_session_id)
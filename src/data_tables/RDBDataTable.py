@@ -1,7 +1,7 @@
-from src.data_tables.BaseDataTable import BaseDataTable
+from src.data_tables.BaseDataTable import BaseDataTable, DataTableException
+from src.data_tables.ConnectionRouter import ConnectionRouter
 
-import pandas as pd
-import pymysql
+import re
 
 import logging
 
@@ -14,7 +14,8 @@ class RDBDataTable(BaseDataTable):
     """
 
     # Default connection information in case the code does not pass an object
-    # specific connection on object creation.
+    # specific connection on object creation. This may also be a primary plus read replicas.
+    # See ConnectionRouter for the format.
     _default_connect_info = {
         'host': 'localhost',
         'user': 'dbuser',
@@ -25,29 +26,24 @@ class RDBDataTable(BaseDataTable):
 
     _default_cnx = None
 
-    def _get_cnx(self):
-
-        if self._cnx is None:
-            if self._connect_info is None:
-                c_info = RDBDataTable._default_connect_info
-            else:
-                c_info = self._connect_info
+    # Table and column names are pasted into SQL, so they must be plain identifiers.
+    _identifier_re = re.compile(r"^[A-Za-z0-9_$]+$")
 
-            self._cnx = pymysql.connect(
-                host=c_info['host'],
-                user=c_info['user'],
-                password=c_info['password'],
-                db=c_info['db'],
-                charset='utf8mb4',
-                cursorclass=pymysql.cursors.DictCursor)
+    # Statements that only read and may run on a replica.
+    _read_statement_re = re.compile(r"^\s*(select|show|describe|desc|explain)\b", re.IGNORECASE)
 
-        return self._cnx
+    def _get_cnx(self):
+        """
+        The calling thread's connection to the primary.
+        """
+        return self._router.get_primary_cnx()
 
     def __init__(self, table_name, key_columns=None, connect_info=None):
         """
 
         :param table_name: The name of the RDB table.
-        :param connect_info: Dictionary of parameters necessary to connect to the data.
+        :param connect_info: Dictionary of parameters necessary to connect to the data. This may describe a
+            single host or a primary plus read replicas. See ConnectionRouter.
         :param key_columns: List, in order, of the columns (fields) that comprise the primary key.
             This is for compatibility with other types of data table. Any value other than None is an error.
         """
@@ -57,23 +53,34 @@ class RDBDataTable(BaseDataTable):
         if key_columns is not None:
             raise ValueError("This is an RDB Data Table. We figure out the keys by querying the DB.")
 
-        ####### Your Code Goes Here #########
-        pass
+        if connect_info is None:
+            connect_info = RDBDataTable._default_connect_info
+
+        parts = table_name.split(".")
+        if len(parts) > 2 or not all(RDBDataTable._identifier_re.match(p) for p in parts):
+            raise DataTableException(DataTableException.invalid_table, "Invalid table name " + table_name)
+
+        super().__init__(table_name, connect_info, key_columns=None)
 
+        self._quoted_table_name = ".".join(RDBDataTable._quote(p) for p in parts)
+        self._columns = None
+        self._write_listeners = []
 
-        ####### Your Code Goes Here #########
+        # Reads go to replicas, if there are any. Writes go to the primary. Tables with the same connect_info
+        # share the router and its connection pools.
+        self._router = ConnectionRouter.get_router(connect_info)
 
     def __str__(self):
         """
 
         :return: String representation of the table's metadata.
         """
-        ####### Your Code Goes Here #########
-        pass
-
-        ####### Your Code Goes Here #########
+        result = "RDBDataTable: table_name = " + self._table_name + ", key_columns = " + str(self._key_columns) + \
+            ", " + str(self._router)
+        return result
 
-    def _run_q(self, q, args=None, fields=None, fetch=True, cnx=None, cursor=None, commit=True):
+    def _run_q(self, q, args=None, fields=None, fetch=True, cnx=None, cursor=None, commit=True, read_only=False,
+               context=None):
         """
 
         :param q: An SQL query string that may have %s slots for argument insertion. The string
@@ -82,20 +89,49 @@ class RDBDataTable(BaseDataTable):
         :param fetch: If true, return the result.
         :param cnx: A database connection. May be None
         :param cncursor: Do not worry about this for now.
-        :param commit: Do not worry about this for now. This is more wizard stuff.
-        :return: A result set or None.
+        :param commit: Commit after the query. This only matters for a cnx passed in by the caller. A connection
+            from the router's pool is in autocommit mode, so a query run on one always commits.
+        :param read_only: True if the query does not change data and may run on a read replica.
+        :param context: Passed to the ConnectionRouter, e.g. { "session_id": ... } for read-your-writes.
+        :return: A result set, or the number of rows changed if fetch is False, or None on an error.
+        """
+
+        if cnx is not None:
+            r, e = self._execute_q(q, args, fields, fetch, cnx, cursor, commit)
+            return r
+
+        # A read that fails because its replica went away is tried once more, on another replica or the primary.
+        attempts = 2 if read_only else 1
+        exclude = None
+
+        for i in range(attempts):
+            lease = self._router.acquire(read_only=read_only, context=context, exclude=exclude)
+            try:
+                r, e = self._execute_q(q, args, fields, fetch, lease.cnx, cursor, commit)
+                if e is not None:
+                    lease.failed(e)
+            finally:
+                lease.release()
+
+            if not ConnectionRouter.is_connection_error(e):
+                break
+
+            exclude = lease.host_index
+
+        return r
+
+    def _execute_q(self, q, args, fields, fetch, cnx, cursor, commit):
+        """
+        Run a query on cnx.
+        :return: (result, exception or None)
         """
 
         r = None
+        error = None
 
         cursor_created = False
 
-        if cnx is None:
-            cnx = self._get_cnx()
-
         try:
-            # Use the connection in the object if no connection provided.
-
             # Convert the list of columns into the form "col1, col2, ..." for following SELECT.
             if fields:
                 q = q.format(",".join(fields))
@@ -116,7 +152,7 @@ class RDBDataTable(BaseDataTable):
             if fetch:
                 r = cursor.fetchall()  # Return all elements of the result.
             else:
-                r = None
+                r = cursor.rowcount
 
             if commit:                  # Do not worry about this for now.
                 cnx.commit()
@@ -126,14 +162,19 @@ class RDBDataTable(BaseDataTable):
 
         except Exception as e:
             print("Exception e = ", e)
-            if commit:
-                cnx.rollback()
-            if cursor_created:
-                cursor.close()
-
-        return r
-
-    def _run_insert(self, table_name, column_list, values_list, cnx=None, commit=True):
+            error = e
+            try:
+                if commit:
+                    cnx.rollback()
+                if cursor_created:
+                    cursor.close()
+            except Exception:
+                # The connection itself is broken. The router drops it on release.
+                pass
+
+        return r, error
+
+    def _run_insert(self, table_name, column_list, values_list, cnx=None, commit=True, context=None):
         """
 
         :param table_name: Name of the table to insert data. Probably should just get from the object data.
@@ -141,7 +182,8 @@ class RDBDataTable(BaseDataTable):
         :param values_list: List of column values.
         :param cnx: Ignore this for now.
         :param commit: Ignore this for now.
-        :return:
+        :param context: Passed to the ConnectionRouter, e.g. { "session_id": ... } for read-your-writes.
+        :return: The number of rows inserted, or None on an error.
         """
         try:
             q = "insert into " + table_name + " "
@@ -161,7 +203,8 @@ class RDBDataTable(BaseDataTable):
             # Put all together.
             q += values
 
-            self._run_q(q, args=values_list, fields=None, fetch=False, cnx=cnx, commit=commit)
+            return self._run_q(q, args=values_list, fields=None, fetch=False, cnx=cnx, commit=commit,
+                               context=context)
 
         except Exception as e:
             print("Got exception = ", e)
@@ -170,6 +213,107 @@ class RDBDataTable(BaseDataTable):
     def get_folders(self):
         pass
 
+    def warm_up(self, n=2):
+        """
+        Open connections and load the table's metadata before the first request needs them.
+        :param n: Number of connections to open to each host.
+        :return: None
+        """
+        self._router.warm_up(n)
+        self._get_columns()
+        self._get_key_columns()
+
+    def add_write_listener(self, listener):
+        """
+        Register a function to call after a successful insert, update or delete through this table, e.g. to keep
+        an in-memory index current. Writes made by other processes or directly in the database are not seen.
+
+        :param listener: Function (old_rows, new_rows). For an insert old_rows is empty, for a delete new_rows is
+            empty and for an update they are the matching rows before and after the update.
+        :return: None
+        """
+        self._write_listeners.append(listener)
+
+    def _notify_write(self, old_rows, new_rows):
+
+        for listener in self._write_listeners:
+            try:
+                listener(old_rows, new_rows)
+            except Exception as e:
+                logger.error("RDBDataTable: write listener failed for " + self._table_name + ". Exception = " +
+                             str(e))
+
+    def _rows_before_write(self, template, context):
+        """
+        The rows a delete or update will change, read from the primary. Only needed if there are listeners.
+        """
+        if not self._write_listeners:
+            return None
+
+        context = dict(context or {}, consistency='primary')
+        return self.find_by_template(template, context=context) or []
+
+    @staticmethod
+    def _quote(identifier):
+        return "`" + identifier + "`"
+
+    def _get_columns(self):
+
+        if self._columns is None:
+            q = "show columns from " + self._quoted_table_name
+            r = self._run_q(q, fetch=True, commit=False, read_only=True)
+            if not r:
+                raise DataTableException(DataTableException.invalid_table,
+                                         "Table " + self._table_name + " does not exist or cannot be read.")
+            self._columns = [c['Field'] for c in r]
+
+        return self._columns
+
+    def _check_columns(self, names):
+        """
+        Raise a DataTableException if any of names is not a column of the table.
+        """
+        columns = self._get_columns()
+        bad = [n for n in names if n not in columns]
+        if bad:
+            raise DataTableException(DataTableException.invalid_column,
+                                     "Unknown columns " + str(bad) + " for table " + self._table_name)
+
+    def _get_key_columns(self):
+
+        if self._key_columns is None:
+            q = "show keys from " + self._quoted_table_name + " where Key_name = 'PRIMARY'"
+            r = self._run_q(q, fetch=True, commit=False, read_only=True)
+            if r:
+                r = sorted(r, key=lambda k: k['Seq_in_index'])
+                self._key_columns = [k['Column_name'] for k in r]
+
+        return self._key_columns
+
+    def get_row_signature(self, key_columns):
+        """
+        A summary of the table's rows for detecting that a cached copy is out of date. The row count and largest
+        key change on most inserts and deletes. CHECKSUM TABLE changes on any change to the rows, including
+        updates in place. It reads the whole table, so call this at startup, not per request.
+
+        :param key_columns: Columns that identify a row.
+        :return: { "row_count": ..., "max_key": ..., "checksum": ... } or None on an error.
+        """
+        self._check_columns(key_columns)
+        key = "concat_ws(','," + ",".join(self._quote(c) for c in key_columns) + ")"
+        q = "select count(*) as row_count, max(" + key + ") as max_key from " + self._quoted_table_name
+
+        r = self._run_q(q, fetch=True, commit=False, read_only=True)
+        if not r:
+            return None
+
+        c = self._run_q("checksum table " + self._quoted_table_name, fetch=True, commit=False, read_only=True)
+        if not c or c[0].get("Checksum", None) is None:
+            return None
+
+        result = {"row_count": r[0]["row_count"], "max_key": r[0]["max_key"], "checksum": c[0]["Checksum"]}
+        return result
+
     def find_by_primary_key(self, key_fields, field_list=None, context=None):
         """
 
@@ -178,25 +322,43 @@ class RDBDataTable(BaseDataTable):
         :return: None, or a dictionary containing the request fields for the record identified
             by the key.
         """
-        pass
-        ####### Your Code Goes Here #########
+        template = dict(zip(self._get_key_columns(), key_fields))
+        result = self.find_by_template(template, field_list=field_list, context=context)
 
+        if result:
+            result = result[0]
+        else:
+            result = None
 
-        ####### Your Code Goes Here #########
+        return result
 
     def _template_to_where_clause(self, t):
         """
         Convert a query template into a WHERE clause.
-        :param t: Query template.
+        :param t: Query template. A value that is a list becomes an IN term.
         :return: (WHERE clause, arg values for %s in clause)
         """
         w_clause = None
         args = None
 
-        ####### Your Code Goes Here #########
-        pass
-
-        ####### Your Code Goes Here #########
+        if t:
+            self._check_columns(t.keys())
+            terms = []
+            args = []
+            for k, v in t.items():
+                # A list of values matches any of them, e.g. { "sceneNo": [1, 2, 3] }
+                if isinstance(v, (list, tuple)):
+                    if v:
+                        terms.append(self._quote(k) + " in (" + ",".join(["%s"] * len(v)) + ")")
+                        args.extend(v)
+                    else:
+                        terms.append("false")
+                else:
+                    terms.append(self._quote(k) + "=%s")
+                    args.append(v)
+            w_clause = " where " + " and ".join(terms)
+        else:
+            w_clause = ""
 
         return w_clause, args
 
@@ -212,18 +374,36 @@ class RDBDataTable(BaseDataTable):
         :return: A list containing dictionaries. A dictionary is in the list representing each record
             that matches the template. The dictionary only contains the requested fields.
         """
-        ####### Your Code Goes Here #########
-        pass
+        w_clause, args = self._template_to_where_clause(template)
+        q = "select {} from " + self._quoted_table_name + w_clause
 
-        ####### Your Code Goes Here #########
+        if field_list:
+            self._check_columns(field_list)
+            field_list = [self._quote(f) for f in field_list]
+
+        result = self._run_q(q, args=args, fields=field_list, fetch=True, commit=False, read_only=True,
+                             context=context)
+        return result
+
+    def _key_to_template(self, key_fields):
+        return dict(zip(self._get_key_columns(), key_fields))
 
     def insert(self, new_record, context=None):
         """
 
         :param new_record: A dictionary representing a row to add to the set of records.
-        :return: None
+        :param context: Passed to the ConnectionRouter, e.g. { "session_id": ... } for read-your-writes.
+        :return: The number of rows inserted, or None on an error.
         """
-        pass
+        self._check_columns(new_record.keys())
+        columns = [self._quote(c) for c in new_record.keys()]
+
+        result = self._run_insert(self._quoted_table_name, columns, list(new_record.values()), context=context)
+
+        if result:
+            self._notify_write([], [new_record])
+
+        return result
 
     def delete_by_template(self, template, context=None):
         """
@@ -233,7 +413,16 @@ class RDBDataTable(BaseDataTable):
         :param template: A template.
         :return: A count of the rows deleted.
         """
-        pass
+        w_clause, args = self._template_to_where_clause(template)
+        q = "delete from " + self._quoted_table_name + w_clause
+
+        old_rows = self._rows_before_write(template, context)
+        result = self._run_q(q, args=args, fetch=False, context=context)
+
+        if result and old_rows is not None:
+            self._notify_write(old_rows, [])
+
+        return result
 
     def delete_by_key(self, key_fields, context=None):
         """
@@ -243,7 +432,7 @@ class RDBDataTable(BaseDataTable):
         :param key_fields: List containing the values for the key columns
         :return: A count of the rows deleted.
         """
-        pass
+        return self.delete_by_template(self._key_to_template(key_fields), context=context)
 
     def update_by_template(self, template, new_values, context=None):
         """
@@ -254,7 +443,20 @@ class RDBDataTable(BaseDataTable):
             update on this error.
         :return: The number of rows updates.
         """
-        pass
+        self._check_columns(new_values.keys())
+        s_clause = ", ".join(self._quote(k) + "=%s" for k in new_values.keys())
+        w_clause, w_args = self._template_to_where_clause(template)
+
+        q = "update " + self._quoted_table_name + " set " + s_clause + w_clause
+        args = list(new_values.values()) + (w_args or [])
+
+        old_rows = self._rows_before_write(template, context)
+        result = self._run_q(q, args=args, fetch=False, context=context)
+
+        if result and old_rows is not None:
+            self._notify_write(old_rows, [dict(r, **new_values) for r in old_rows])
+
+        return result
 
     def update_by_key(self, key_fields, new_values, context=None):
         """
@@ -265,7 +467,7 @@ class RDBDataTable(BaseDataTable):
             update on this error.
         :return: The number of rows updates.
         """
-        pass
+        return self.update_by_template(self._key_to_template(key_fields), new_values, context=context)
 
     def load(self, rows=None):
         pass
@@ -274,7 +476,17 @@ class RDBDataTable(BaseDataTable):
         pass
 
     def query(self, query_statement, args, context=None):
-        pass
+        """
+        Runs a raw SQL statement. A SELECT (or SHOW, DESCRIBE, EXPLAIN) may run on a replica. Any other
+        statement runs on the primary.
+        :return: The result set of a read, or the number of rows changed by any other statement. None on an error.
+        """
+        if RDBDataTable._read_statement_re.match(query_statement):
+            result = self._run_q(query_statement, args=args, fetch=True, commit=False, read_only=True,
+                                 context=context)
+        else:
+            result = self._run_q(query_statement, args=args, fetch=False, context=context)
+        return result
 
 
 
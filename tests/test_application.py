@@ -0,0 +1,187 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("flask")
+
+import application
+from src.data_tables.ConnectionRouter import ConnectionRouter
+
+
+class FakeTable():
+
+    def __init__(self, rows, checksum=1):
+        self._rows = rows
+        self.checksum = checksum
+        self.listeners = []
+
+    def find_by_template(self, template, field_list=None):
+        return self._rows
+
+    def get_row_signature(self, key_columns):
+        return {"row_count": len(self._rows or []), "max_key": None, "checksum": self.checksum}
+
+    def add_write_listener(self, listener):
+        self.listeners.append(listener)
+
+    def warm_up(self, n=2):
+        if self._rows is None:
+            raise RuntimeError("Can't connect to MySQL server")
+        self.warmed_up = True
+
+
+_relationships = [
+    {"characterName": "Eddard Stark", "label": "parentOf", "value": "Arya Stark"},
+    {"characterName": "Eddard Stark", "label": "parentOf", "value": "Robb Stark"},
+    {"characterName": "Robb Stark", "label": "killedBy", "value": "Roose Bolton"},
+]
+
+
+class ApplicationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = application.application.test_client()
+        application._graphs.clear()
+        self.addCleanup(application._graphs.clear)
+        application._search_indexes.clear()
+        self.addCleanup(application._search_indexes.clear)
+
+        index_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(index_dir.cleanup)
+        patcher = mock.patch.object(application, "_search_index_dir", index_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def use_table(self, tbl):
+        patcher = mock.patch.object(application, "_get_table", lambda db_name, t_name: tbl)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_graph_route(self):
+        tbl = FakeTable(_relationships)
+        self.use_table(tbl)
+
+        rsp = self.client.get("/api/got/_graph/neighborhood?source=Eddard Stark&labels=parentOf")
+        self.assertEqual(rsp.status_code, 200)
+        self.assertEqual(sorted(r["name"] for r in rsp.get_json()), ["Arya Stark", "Robb Stark"])
+
+        self.assertEqual(self.client.get("/api/got/_graph/path?source=Eddard Stark").status_code, 400)
+        self.assertEqual(self.client.get("/api/got/_graph/bfs?source=Nobody").status_code, 404)
+        self.assertEqual(len(tbl.listeners), 1)
+
+    def test_failed_graph_load_is_not_cached(self):
+        tbl = FakeTable(None)
+        self.use_table(tbl)
+
+        self.assertEqual(self.client.get("/api/got/_graph/bfs?source=Eddard Stark").status_code, 500)
+        self.assertEqual(application._graphs, {})
+        self.assertEqual(tbl.listeners, [])
+
+    def test_search_route(self):
+        self.use_table(FakeTable([{"character_id": "CH_1", "characterName": "Jon Snow", "nickname": "Lord Snow"}]))
+
+        rsp = self.client.get("/api/got/characters/search?q=sno&limit=5")
+        self.assertEqual(rsp.status_code, 200)
+        self.assertEqual(rsp.get_json()[0]["row"]["character_id"], "CH_1")
+
+        self.assertEqual(self.client.get("/api/got/characters/search?q=snow&limit=x").status_code, 400)
+        self.assertEqual(self.client.get("/api/got/houses/search?q=stark").status_code, 404)
+
+    def test_failed_search_index_load_is_not_cached(self):
+        tbl = FakeTable(None)
+        self.use_table(tbl)
+
+        self.assertEqual(self.client.get("/api/got/characters/search?q=snow").status_code, 500)
+        self.assertEqual(application._search_indexes, {})
+        self.assertEqual(os.listdir(application._search_index_dir), [])
+        self.assertEqual(tbl.listeners, [])
+
+    def test_saved_search_index_is_rebuilt_after_update(self):
+        tbl = FakeTable([{"character_id": "CH_1", "characterName": "Jon Snow", "nickname": None}])
+        self.use_table(tbl)
+        application._get_search_index("got", "characters")
+
+        # An update in place keeps the row count and keys but changes the checksum.
+        tbl._rows = [{"character_id": "CH_1", "characterName": "Aegon Targaryen", "nickname": None}]
+        tbl.checksum = 2
+        application._search_indexes.clear()
+
+        idx = application._get_search_index("got", "characters")
+        self.assertEqual(idx.search("snow"), [])
+        self.assertEqual(len(idx.search("aegon")), 1)
+
+    def test_table_response_logs_size_not_rows(self):
+        self.use_table(FakeTable([{"character_id": "CH_1", "characterName": "Jon Snow"}]))
+
+        with mock.patch.object(application, "log_response") as log_response:
+            rsp = self.client.get("/api/got/characters?characterName=Jon Snow")
+
+        self.assertEqual(rsp.status_code, 200)
+        self.assertEqual(log_response.call_args.args[2], {"bytes": len(rsp.get_data())})
+
+
+class FakeConnection():
+
+    def close(self):
+        pass
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_health_waits_for_warm_up(self):
+        client = application.application.test_client()
+
+        with mock.patch.object(application, "_ready", threading.Event()) as ready:
+            self.assertEqual(client.get("/health").status_code, 503)
+            ready.set()
+            rsp = client.get("/health")
+
+        self.assertEqual(rsp.status_code, 200)
+        self.assertEqual(rsp.get_json()["status"], "healthy")
+
+    def test_warm_up_survives_failures(self):
+        tables = {"broken": FakeTable(None), "characters": FakeTable([])}
+
+        with mock.patch.object(application, "_warmup_tables", ["got.broken", "got.characters"]), \
+                mock.patch.object(application, "_get_table", lambda db_name, t_name: tables[t_name]), \
+                self.assertLogs(level="ERROR") as logs:
+            application._warm_up(build_caches=False)
+
+        self.assertTrue(tables["characters"].warmed_up)
+        self.assertIn("got.broken", logs.output[0])
+
+    def test_fork_resets_connections_and_warms_up(self):
+        router = ConnectionRouter.get_router({'host': 'localhost', 'user': 'dbuser', 'password': 'dbuserdbuser',
+                                              'db': 'fork_test', 'port': 3306})
+        router._connect = lambda i, autocommit=True: FakeConnection()
+        router.warm_up(2)
+        self.assertEqual(router.get_stats()[0]["idle"], 2)
+
+        # A fork in the middle of a warm-up. The child must not stay unhealthy.
+        application._ready.clear()
+        self.addCleanup(application._ready.set)
+
+        r, w = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            result = "failed"
+            try:
+                os.close(r)
+                if router.get_stats()[0]["idle"] == 0 and application._ready.wait(5):
+                    result = "ok"
+            finally:
+                os.write(w, result.encode())
+                os._exit(0)
+
+        os.close(w)
+        with os.fdopen(r) as in_file:
+            result = in_file.read()
+        os.waitpid(pid, 0)
+
+        self.assertEqual(result, "ok")
+        self.assertEqual(router.get_stats()[0]["idle"], 2)
@@ -0,0 +1,163 @@
+from decimal import Decimal
+import unittest
+
+from src.data_queries_tools_views.BatchExecutor import BatchExecutor
+
+
+class FakeTable():
+    """
+    A data table over a list of rows. A list value in a template matches any of its values. Numbers are compared
+    by value, as MySQL does, e.g. 1.00 matches '1'.
+    """
+
+    def __init__(self, rows, calls, fail=False):
+        self._rows = rows
+        self._calls = calls
+        self._fail = fail
+
+    def find_by_template(self, template, field_list=None):
+        self._calls.append(template)
+
+        if self._fail:
+            return None
+
+        def same(x, y):
+            try:
+                return Decimal(str(x)) == Decimal(str(y))
+            except ArithmeticError:
+                return str(x) == str(y)
+
+        def matches(r):
+            for k, v in template.items():
+                values = v if isinstance(v, list) else [v]
+                if not any(same(r[k], x) for x in values):
+                    return False
+            return True
+
+        return [{k: r[k] for k in (field_list or r.keys())} for r in self._rows if matches(r)]
+
+
+_tables = {
+    "episodes": [
+        {"seasonNum": 1, "episodeNum": 1, "episodeTitle": "Winter Is Coming"},
+        {"seasonNum": 1, "episodeNum": 2, "episodeTitle": "The Kingsroad"},
+    ],
+    "scenes": [
+        {"seasonNum": 1, "episodeNum": 1, "sceneNo": 1},
+        {"seasonNum": 1, "episodeNum": 1, "sceneNo": 2},
+        {"seasonNum": 1, "episodeNum": 2, "sceneNo": 1},
+    ],
+    "characters": [
+        {"id": 1, "characterName": "Jon Snow"},
+        {"id": 2, "characterName": "Arya Stark"},
+    ],
+}
+
+
+class BatchExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.failing = set()
+        self.executor = BatchExecutor(
+            lambda dbname, tablename: FakeTable(_tables[tablename], self.calls, tablename in self.failing))
+
+    def test_refs(self):
+        result = self.executor.execute([
+            {"id": "ep", "tablename": "episodes", "template": {"seasonNum": 1, "episodeNum": 2}},
+            {"id": "sc", "tablename": "scenes", "fields": ["sceneNo"],
+             "template": {"seasonNum": {"$ref": "ep.seasonNum"}, "episodeNum": {"$ref": "ep.episodeNum"}}}
+        ], dbname="got")
+
+        self.assertEqual(result["errors"], {})
+        self.assertEqual(result["results"]["ep"][0]["episodeTitle"], "The Kingsroad")
+        self.assertEqual(result["results"]["sc"], [{"sceneNo": 1}])
+
+    def test_integer_lookups_are_merged(self):
+        result = self.executor.execute([
+            {"id": "a", "tablename": "characters", "template": {"id": 1}, "fields": ["characterName"]},
+            {"id": "b", "tablename": "characters", "template": {"id": "2"}, "fields": ["characterName"]},
+            {"id": "c", "tablename": "characters", "template": {"id": 3}, "fields": ["characterName"]},
+        ], dbname="got")
+
+        self.assertEqual(self.calls, [{"id": [1, "2", 3]}])
+        self.assertEqual(result["results"], {"a": [{"characterName": "Jon Snow"}],
+                                             "b": [{"characterName": "Arya Stark"}],
+                                             "c": []})
+
+    def test_merged_lookups_match_numerically(self):
+        # MySQL compares a DECIMAL or FLOAT column with '1' numerically and returns the column's own type.
+        rows = [{"price": Decimal("1.00"), "name": "a"}, {"price": 2.0, "name": "b"}]
+        executor = BatchExecutor(lambda dbname, tablename: FakeTable(rows, self.calls))
+
+        result = executor.execute([
+            {"id": "a", "tablename": "prices", "template": {"price": "1"}},
+            {"id": "b", "tablename": "prices", "template": {"price": 2}},
+        ], dbname="got")
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(result["results"]["a"], [rows[0]])
+        self.assertEqual(result["results"]["b"], [rows[1]])
+
+    def test_driver_errors_are_not_returned(self):
+        class BrokenTable():
+            def find_by_template(self, template, field_list=None):
+                raise RuntimeError("Can't connect to MySQL server on 'db-primary.internal'")
+
+        executor = BatchExecutor(lambda dbname, tablename: BrokenTable())
+        result = executor.execute([{"id": "a", "tablename": "episodes"}], dbname="got")
+
+        self.assertEqual(result["errors"], {"a": "Query failed."})
+
+    def test_string_lookups_are_not_merged(self):
+        self.executor.execute([
+            {"id": "a", "tablename": "characters", "template": {"characterName": "jon snow"}},
+            {"id": "b", "tablename": "characters", "template": {"characterName": "Arya Stark"}},
+        ], dbname="got")
+
+        self.assertEqual(len(self.calls), 2)
+
+    def test_failed_query_is_an_error(self):
+        self.failing.add("episodes")
+        result = self.executor.execute([
+            {"id": "ep", "tablename": "episodes", "template": {"seasonNum": 1, "episodeNum": 1}},
+            {"id": "sc", "tablename": "scenes", "template": {"episodeNum": {"$ref": "ep.episodeNum"}}},
+            {"id": "ch", "tablename": "characters", "template": {"id": 1}},
+        ], dbname="got")
+
+        self.assertEqual(set(result["errors"].keys()), {"ep", "sc"})
+        self.assertEqual(list(result["results"].keys()), ["ch"])
+
+    def test_failed_merged_query_is_an_error(self):
+        self.failing.add("characters")
+        result = self.executor.execute([
+            {"id": "a", "tablename": "characters", "template": {"id": 1}},
+            {"id": "b", "tablename": "characters", "template": {"id": 2}},
+        ], dbname="got")
+
+        self.assertEqual(set(result["errors"].keys()), {"a", "b"})
+        self.assertEqual(result["results"], {})
+
+    def test_invalid_batches(self):
+        invalid = [
+            [],
+            [{"template": {}}],
+            [{"tablename": "episodes", "template": [1]}],
+            [{"tablename": "episodes", "fields": "episodeTitle"}],
+            [{"tablename": "episodes", "fields": [1]}],
+            [{"tablename": "episodes", "template": {"seasonNum": {"$ref": "nothing"}}}],
+            [{"tablename": "episodes", "template": {"seasonNum": {"$ref": "x.seasonNum"}}}],
+            [{"id": "a", "tablename": "episodes"}, {"id": "a", "tablename": "scenes"}],
+        ]
+
+        for operations in invalid:
+            with self.assertRaises(ValueError):
+                self.executor.execute(operations, dbname="got")
+
+    def test_circular_reference(self):
+        result = self.executor.execute([
+            {"id": "a", "tablename": "episodes", "template": {"seasonNum": {"$ref": "b.seasonNum"}}},
+            {"id": "b", "tablename": "episodes", "template": {"seasonNum": {"$ref": "a.seasonNum"}}},
+        ], dbname="got")
+
+        self.assertEqual(set(result["errors"].keys()), {"a", "b"})
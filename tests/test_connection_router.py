@@ -0,0 +1,255 @@
+import sys
+import unittest
+from unittest import mock
+
+from src.data_tables.BaseDataTable import DataTableException
+from src.data_tables.ConnectionRouter import ConnectionRouter
+from src.data_tables.RDBDataTable import RDBDataTable
+
+
+class OperationalError(Exception):
+    """
+    The router recognizes connection errors by their DB API class name, so the tests do not need pymysql.
+    """
+    pass
+
+
+class FakeCursor():
+
+    def __init__(self, cnx):
+        self._cnx = cnx
+        self._q = None
+        self.rowcount = 0
+
+    def execute(self, q, args=None):
+        if self._cnx.port in self._cnx.failing_ports:
+            raise OperationalError(2013, "Lost connection to MySQL server during query")
+        self._q = q
+        self._cnx.queries.append(q)
+        self.rowcount = 1
+
+    def fetchall(self):
+        if self._q.startswith("show columns"):
+            return [{"Field": "id"}, {"Field": "characterName"}]
+        if self._q.startswith("show keys"):
+            return [{"Column_name": "id", "Seq_in_index": 1}]
+        if self._q.startswith("checksum table"):
+            return [{"Table": "characters", "Checksum": 1234}]
+        if self._q.startswith("select count(*)"):
+            return [{"row_count": 2, "max_key": "2"}]
+        return [{"port": self._cnx.port}]
+
+    def close(self):
+        pass
+
+
+class FakeConnection():
+
+    def __init__(self, port, queries, failing_ports, autocommit=True):
+        self.port = port
+        self.autocommit = autocommit
+        self.queries = queries
+        self.failing_ports = failing_ports
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def ping(self, reconnect=False):
+        pass
+
+
+def make_connect_info(db, n_replicas=2, **kwargs):
+    result = {
+        'primary': {'host': 'localhost', 'user': 'dbuser', 'password': 'dbuserdbuser', 'db': db, 'port': 3306},
+        'replicas': [{'port': 3307 + i} for i in range(n_replicas)]
+    }
+    result.update(kwargs)
+    return result
+
+
+class FakeHosts():
+    """
+    Replaces a router's connect with fake connections. Ports in down_ports refuse connections and ports in
+    failing_ports lose the connection during a query.
+    """
+
+    def setUp(self):
+        self.queries = []
+        self.failing_ports = set()      # execute() fails on these ports.
+        self.down_ports = set()         # connect() fails on these ports.
+
+    def fake_connect(self, router):
+        def connect(i, autocommit=True):
+            port = router._hosts[i]['port']
+            if port in self.down_ports:
+                raise OperationalError(2003, "Can't connect to MySQL server")
+            return FakeConnection(port, self.queries, self.failing_ports, autocommit)
+        router._connect = connect
+        return router
+
+
+class ConnectionRouterTest(FakeHosts, unittest.TestCase):
+
+    def make_router(self, **kwargs):
+        return self.fake_connect(ConnectionRouter(make_connect_info("router_test", **kwargs)))
+
+    def ports(self, router, n, read_only=True, context=None):
+        result = []
+        for i in range(n):
+            lease = router.acquire(read_only=read_only, context=context)
+            result.append(lease.cnx.port)
+            lease.release()
+        return result
+
+    def test_autocommit(self):
+        router = ConnectionRouter(make_connect_info("router_test"))
+        driver = mock.MagicMock()
+        with mock.patch.dict(sys.modules, {"pymysql": driver}):
+            router._connect(1)
+            self.assertTrue(driver.connect.call_args.kwargs["autocommit"])
+            router._connect(0, autocommit=False)
+            self.assertFalse(driver.connect.call_args.kwargs["autocommit"])
+
+        # Pooled connections commit every statement. The thread's own primary connection does not.
+        router = self.make_router()
+        lease = router.acquire(read_only=False)
+        self.assertTrue(lease.cnx.autocommit)
+        lease.release()
+        self.assertFalse(router.get_primary_cnx().autocommit)
+
+    def test_query_errors_do_not_eject(self):
+        self.assertTrue(ConnectionRouter.is_connection_error(OperationalError(2013, "Lost connection")))
+        self.assertFalse(ConnectionRouter.is_connection_error(ValueError("Unknown column")))
+        self.assertFalse(ConnectionRouter.is_connection_error(None))
+
+    def test_writes_go_to_primary(self):
+        router = self.make_router()
+        self.assertEqual(self.ports(router, 3, read_only=False), [3306, 3306, 3306])
+
+    def test_reads_round_robin_over_replicas(self):
+        router = self.make_router()
+        self.assertEqual(sorted(self.ports(router, 4)), [3307, 3307, 3308, 3308])
+
+    def test_least_loaded(self):
+        router = self.make_router(replica_policy='least_loaded')
+        busy = router.acquire(read_only=True)
+        lease = router.acquire(read_only=True)
+        self.assertNotEqual(lease.cnx.port, busy.cnx.port)
+        lease.release()
+        busy.release()
+
+    def test_unreachable_replica_is_ejected(self):
+        router = self.make_router()
+        self.down_ports.add(3307)
+        self.assertEqual(self.ports(router, 4), [3308, 3308, 3308, 3308])
+        self.assertFalse(router.get_stats()[1]["healthy"])
+
+    def test_fallback_to_primary(self):
+        router = self.make_router()
+        self.down_ports.update([3307, 3308])
+        self.assertEqual(self.ports(router, 2), [3306, 3306])
+
+    def test_read_your_writes(self):
+        router = self.make_router()
+        self.ports(router, 1, read_only=False, context={'session_id': 's1'})
+        self.assertEqual(self.ports(router, 2, context={'session_id': 's1'}), [3306, 3306])
+        self.assertNotIn(3306, self.ports(router, 2, context={'session_id': 's2'}))
+        self.assertEqual(self.ports(router, 1, context={'consistency': 'primary'}), [3306])
+
+    def test_read_your_writes_expires(self):
+        router = self.make_router(read_your_writes_seconds=0)
+        self.ports(router, 1, read_only=False, context={'session_id': 's1'})
+        self.assertNotIn(3306, self.ports(router, 2, context={'session_id': 's1'}))
+
+    def test_pool_reuses_connections(self):
+        router = self.make_router(n_replicas=0)
+        lease = router.acquire()
+        cnx = lease.cnx
+        lease.release()
+        lease = router.acquire()
+        self.assertIs(lease.cnx, cnx)
+        lease.release()
+
+    def test_connections_are_dropped_in_a_child_process(self):
+        router = self.make_router(n_replicas=0)
+        lease = router.acquire()
+        cnx = lease.cnx
+        lease.release()
+
+        with mock.patch("os.getpid", return_value=-1):
+            lease = router.acquire()
+            self.assertIsNot(lease.cnx, cnx)
+            lease.release()
+
+    def test_shared_router(self):
+        info = make_connect_info("router_test_shared")
+        self.assertIs(ConnectionRouter.get_router(info), ConnectionRouter.get_router(dict(info)))
+        self.assertIsNot(ConnectionRouter.get_router(info),
+                         ConnectionRouter.get_router(make_connect_info("router_test_other")))
+
+
+class RDBDataTableRoutingTest(FakeHosts, unittest.TestCase):
+
+    def make_table(self, db):
+        tbl = RDBDataTable(db + ".characters", connect_info=make_connect_info(db))
+        self.fake_connect(tbl._router)
+        return tbl
+
+    def test_read_retried_after_replica_failure(self):
+        tbl = self.make_table("table_test_retry")
+        self.failing_ports.add(3307)
+
+        for i in range(3):
+            self.assertIn(tbl.find_by_template({"id": 1})[0]["port"], (3306, 3308))
+
+        self.assertFalse(tbl._router.get_stats()[1]["healthy"])
+
+    def test_write_pins_session_to_primary(self):
+        tbl = self.make_table("table_test_session")
+        context = {'session_id': 's1'}
+
+        self.assertEqual(tbl.insert({"id": 1, "characterName": "Jon Snow"}, context=context), 1)
+        self.assertEqual(tbl.find_by_template({"id": 1}, context=context)[0]["port"], 3306)
+
+    def test_raw_query_routing(self):
+        tbl = self.make_table("table_test_query")
+
+        self.assertNotEqual(tbl.query("select * from characters", None)[0]["port"], 3306)
+        self.assertNotEqual(tbl.query("  SHOW tables", None)[0]["port"], 3306)
+
+        self.failing_ports.update([3307, 3308])
+        self.assertEqual(tbl.query("update characters set characterName = %s", ["Jon"]), 1)
+        self.assertTrue(tbl._router.get_stats()[1]["healthy"])
+
+    def test_row_signature(self):
+        tbl = self.make_table("table_test_signature")
+        self.assertEqual(tbl.get_row_signature(["id"]), {"row_count": 2, "max_key": "2", "checksum": 1234})
+        self.assertEqual(self.queries[-1], "checksum table `table_test_signature`.`characters`")
+
+    def test_identifiers_are_quoted(self):
+        tbl = self.make_table("table_test_quote")
+        tbl.find_by_template({"id": 1}, field_list=["characterName"])
+        self.assertEqual(self.queries[-1],
+                         "select `characterName` from `table_test_quote`.`characters` where `id`=%s")
+
+    def test_unknown_column(self):
+        tbl = self.make_table("table_test_column")
+        with self.assertRaises(DataTableException) as e:
+            tbl.find_by_template({"id = 1 or 1": 1})
+        self.assertEqual(e.exception.code, DataTableException.invalid_column)
+        with self.assertRaises(DataTableException):
+            tbl.find_by_template({}, field_list=["password"])
+
+    def test_invalid_table_name(self):
+        with self.assertRaises(DataTableException) as e:
+            RDBDataTable("db.characters; drop table x", connect_info=make_connect_info("table_test_name"))
+        self.assertEqual(e.exception.code, DataTableException.invalid_table)
@@ -0,0 +1,77 @@
+import os
+import unittest
+
+from src.data_queries_tools_views.RelationshipGraph import RelationshipGraph
+
+_csv_file = os.path.join(os.path.dirname(__file__), "..", "Data", "csv", "character_relationships.csv")
+
+
+class RelationshipGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.g = RelationshipGraph.from_csv(_csv_file)
+
+    def names(self, result):
+        return [r["name"] for r in result]
+
+    def test_attribute_labels_are_not_edges(self):
+        self.assertNotIn("houseName", self.g.labels())
+        self.assertNotIn("actors", self.g.labels())
+        self.assertIsNone(self.g.bfs("Stark"))
+
+    def test_bfs_descendants(self):
+        result = self.g.bfs("Eddard Stark", labels=["parentOf"])
+        self.assertEqual(result[0], {"name": "Eddard Stark", "hops": 0})
+        self.assertEqual(sorted(self.names(result[1:])),
+                         ["Arya Stark", "Bran Stark", "Rickon Stark", "Robb Stark", "Sansa Stark"])
+        self.assertTrue(all(r["hops"] == 1 for r in result[1:]))
+
+    def test_bfs_unknown_node(self):
+        self.assertIsNone(self.g.bfs("Nobody"))
+
+    def test_neighborhood(self):
+        one = self.g.neighborhood("Jon Snow", 1, direction="both")
+        three = self.g.neighborhood("Jon Snow", 3, direction="both")
+
+        self.assertNotIn("Jon Snow", self.names(three))
+        self.assertTrue(set(self.names(one)) < set(self.names(three)))
+        self.assertTrue(all(1 <= r["hops"] <= 3 for r in three))
+        self.assertEqual(sorted(self.names(self.g.neighbors("Jon Snow", labels=["parents"]))),
+                         ["Lyanna Stark", "Rhaegar Targaryen"])
+
+    def test_shortest_path(self):
+        path = self.g.shortest_path("Jon Snow", "Cersei Lannister", direction="both")
+        self.assertEqual(path[0], "Jon Snow")
+        self.assertEqual(path[-1], "Cersei Lannister")
+        self.assertEqual(len(path), 4)
+
+        self.assertIsNone(self.g.shortest_path("Jon Snow", "Nobody"))
+        self.assertIsNone(self.g.shortest_path("Eddard Stark", "Jon Snow", labels=["killed"]))
+
+    def test_add_and_remove_rows(self):
+        row = {"characterName": "Jon Snow", "label": "parentOf", "value": "New Character"}
+
+        self.assertEqual(self.g.add_rows([row]), 1)
+        self.assertEqual(self.g.add_rows([row]), 0)
+        self.assertIn("New Character", self.names(self.g.neighbors("Jon Snow", labels=["parentOf"])))
+        self.assertEqual(self.names(self.g.neighbors("New Character", labels=["parentOf"], direction="in")),
+                         ["Jon Snow"])
+
+        self.assertEqual(self.g.remove_rows([row]), 1)
+        self.assertEqual(self.g.neighbors("Jon Snow", labels=["parentOf"]), [])
+
+    def test_new_node_does_not_break_other_labels(self):
+        self.g.bfs("Jon Snow")
+        self.g.add_rows([{"characterName": "New Character", "label": "killed", "value": "Other Character"}])
+
+        self.assertEqual(self.names(self.g.neighbors("New Character")), ["Other Character"])
+        self.assertEqual(self.g.neighbors("New Character", labels=["siblings"]), [])
+
+    def test_update_rows(self):
+        old = {"characterName": "Eddard Stark", "label": "parentOf", "value": "Arya Stark"}
+        new = {"characterName": "Eddard Stark", "label": "parentOf", "value": "Someone Else"}
+        self.g.update_rows([old], [new])
+
+        children = self.names(self.g.neighbors("Eddard Stark", labels=["parentOf"]))
+        self.assertIn("Someone Else", children)
+        self.assertNotIn("Arya Stark", children)
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+
+from src.data_queries_tools_views.SearchIndex import SearchIndex
+
+
+def make_rows():
+    return [
+        {"character_id": "CH_1", "characterName": "Jon Snow", "nickname": "Lord Snow"},
+        {"character_id": "CH_2", "characterName": "Daenerys Targaryen", "nickname": "Mother of Dragons"},
+        {"character_id": "CH_3", "characterName": "Viserys Targaryen", "nickname": None},
+        {"character_id": "CH_4", "characterName": "Arya Stark", "nickname": "Arry"},
+    ]
+
+
+class SearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.idx = SearchIndex(["characterName", "nickname"], ["character_id"])
+        self.idx.add_rows(make_rows())
+
+    def ids(self, result):
+        return [r["row"]["character_id"] for r in result]
+
+    def test_tokenize(self):
+        self.assertEqual(SearchIndex.tokenize("Jon Snow, the King in the North!"),
+                         ["jon", "snow", "the", "king", "in", "the", "north"])
+        self.assertEqual(SearchIndex.tokenize(None), [])
+
+    def test_exact_and_prefix(self):
+        self.assertEqual(sorted(self.ids(self.idx.search("targaryen"))), ["CH_2", "CH_3"])
+        self.assertEqual(sorted(self.ids(self.idx.search("targ"))), ["CH_2", "CH_3"])
+        self.assertEqual(self.idx.search("targ", prefix=False), [])
+        self.assertEqual(self.ids(self.idx.search("ARR")), ["CH_4"])
+
+    def test_ranking(self):
+        # 'snow' appears twice for Jon Snow, so it outranks a document with one matching word.
+        self.idx.add_rows([{"character_id": "CH_5", "characterName": "Ramsay Snow", "nickname": "Ramsay Bolton"}])
+        result = self.idx.search("snow")
+        self.assertEqual(self.ids(result), ["CH_1", "CH_5"])
+        self.assertGreater(result[0]["score"], result[1]["score"])
+
+        # More matching query words rank higher.
+        self.assertEqual(self.ids(self.idx.search("viserys targaryen"))[0], "CH_3")
+
+    def test_limit(self):
+        self.assertEqual(len(self.idx.search("targaryen", limit=1)), 1)
+
+    def test_add_rows_replaces_row(self):
+        self.idx.add_rows([{"character_id": "CH_1", "characterName": "Aegon Targaryen", "nickname": None}])
+
+        self.assertEqual(len(self.idx), 4)
+        self.assertEqual(self.idx.search("snow"), [])
+        self.assertIn("CH_1", self.ids(self.idx.search("aegon")))
+
+    def test_remove_rows(self):
+        self.assertEqual(self.idx.remove_rows([{"character_id": "CH_2"}, {"character_id": "CH_99"}]), 1)
+        self.assertEqual(self.ids(self.idx.search("targaryen")), ["CH_3"])
+        self.assertEqual(self.idx.search("dragons"), [])
+
+    def test_update_rows(self):
+        old = {"character_id": "CH_4", "characterName": "Arya Stark", "nickname": "Arry"}
+        new = {"character_id": "CH_4", "characterName": "Arya Stark", "nickname": "No One"}
+        self.idx.update_rows([old], [new])
+
+        self.assertEqual(self.idx.search("arry"), [])
+        self.assertEqual(self.ids(self.idx.search("no one")), ["CH_4"])
+
+    def test_save_and_load(self):
+        self.idx.version = {"row_count": 4}
+
+        with tempfile.TemporaryDirectory() as d:
+            file_name = os.path.join(d, "characters.idx")
+            self.idx.save(file_name)
+            loaded = SearchIndex.load(file_name)
+
+        self.assertEqual(loaded.version, {"row_count": 4})
+        self.assertEqual(len(loaded), 4)
+        self.assertEqual(loaded.search("targ"), self.idx.search("targ"))
+
+        loaded.add_rows([{"character_id": "CH_5", "characterName": "Tyrion Lannister", "nickname": "The Imp"}])
+        self.assertEqual(self.ids(loaded.search("imp")), ["CH_5"])
@@ -0,0 +1,106 @@
+import threading
+import time
+import unittest
+
+from src.data_queries_tools_views.SingleFlight import SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def run_callers(self, sf, n, fn, key="k"):
+        """
+        Start n callers of sf.do(key, fn) and wait for all of them.
+        :return: List of (result, shared) or exceptions.
+        """
+        results = []
+        lock = threading.Lock()
+
+        def call():
+            try:
+                r = sf.do(key, fn)
+            except Exception as e:
+                r = e
+            with lock:
+                results.append(r)
+
+        threads = [threading.Thread(target=call) for i in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        return results
+
+    def blocking_fn(self, sf, n_waiting, result="rows"):
+        """
+        A function that counts its runs and does not return until n_waiting other callers are coalesced onto it
+        or have run it themselves.
+        """
+        runs = []
+        lock = threading.Lock()
+
+        def fn():
+            with lock:
+                runs.append(1)
+            while True:
+                stats = sf.get_stats()
+                if stats["calls"] >= n_waiting:
+                    break
+                time.sleep(0.001)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        return fn, runs
+
+    def test_concurrent_calls_share_one_run(self):
+        sf = SingleFlight(max_waiters=100)
+        fn, runs = self.blocking_fn(sf, 5)
+
+        results = self.run_callers(sf, 5, fn)
+
+        self.assertEqual(len(runs), 1)
+        self.assertTrue(all(r[0] == "rows" for r in results))
+        self.assertEqual(sorted(r[1] for r in results), [False, True, True, True, True])
+        self.assertEqual(sf.get_stats(), {"calls": 5, "executions": 1, "coalesced": 4, "overflow": 0,
+                                          "in_flight": 0, "coalesced_ratio": 0.8})
+
+    def test_waiters_are_bounded(self):
+        sf = SingleFlight(max_waiters=2)
+        fn, runs = self.blocking_fn(sf, 5)
+
+        results = self.run_callers(sf, 5, fn)
+
+        # One leader, two waiters, and two callers past the limit that run the function themselves.
+        self.assertEqual(len(runs), 3)
+        self.assertEqual(sorted(r[1] for r in results), [False, False, False, True, True])
+        stats = sf.get_stats()
+        self.assertEqual((stats["executions"], stats["coalesced"], stats["overflow"]), (3, 2, 2))
+
+    def test_exception_reaches_every_waiter(self):
+        sf = SingleFlight(max_waiters=100)
+        error = ValueError("query failed")
+        fn, runs = self.blocking_fn(sf, 4, result=error)
+
+        results = self.run_callers(sf, 4, fn)
+
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(results, [error] * 4)
+        self.assertEqual(sf.get_stats()["in_flight"], 0)
+
+    def test_no_caching_after_completion(self):
+        sf = SingleFlight()
+        runs = []
+
+        def fn():
+            runs.append(1)
+            return len(runs)
+
+        self.assertEqual(sf.do("k", fn), (1, False))
+        self.assertEqual(sf.do("k", fn), (2, False))
+
+    def test_different_keys_do_not_coalesce(self):
+        sf = SingleFlight()
+        self.assertEqual(sf.do("a", lambda: "a"), ("a", False))
+        self.assertEqual(sf.do("b", lambda: "b"), ("b", False))
+        self.assertEqual(sf.get_stats()["coalesced"], 0)